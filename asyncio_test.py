@@ -2,6 +2,7 @@ import asyncio
 import time
 import shutil
 import os
+import queue
 import threading
 
 import cv2
@@ -10,15 +11,15 @@ import numpy as np
 
 class Timer:
     def __init__(self):
-        self._start_time = time.time()
+        self._start_time = time.perf_counter()
 
     def start(self):
-        self._start_time = time.time()
+        self._start_time = time.perf_counter()
 
     def wait(self, wait_msec: float, dt_msec: float | None = 10):
 
         while True:
-            time_from_start = time.time() - self._start_time
+            time_from_start = time.perf_counter() - self._start_time
 
             if time_from_start * 1000 > wait_msec:
                 break
@@ -29,18 +30,255 @@ class Timer:
             time.sleep(dt_msec / 1000)
 
     def show(self):
-        _time = time.time() - self._start_time
+        _time = time.perf_counter() - self._start_time
 
         return _time * 1000
 
 
+class PeriodicScheduler:
+    """
+    一定周期で処理を行うためのスケジューラ。
+    締切時刻を開始時刻 + n * 周期で決めるため、処理時間や待ち時間の誤差が累積しない。
+    締切のspin_usec前まではsleepし、残りの時間だけperf_counter_nsを確認しながら待つ。
+    締切からの遅れはbin_usec刻みのヒストグラムに記録する。
+    sleepの精度が低い環境(Windowsなど)では、spin_usecを大きくする。
+    asyncioのイベントループはsleepの待ち時間をmsec単位に切り上げるため、wait_asyncはasync_spin_usecを使う。
+    """
+
+    def __init__(self,
+                 period_msec: float = 10,
+                 spin_usec: float = 500,
+                 async_spin_usec: float = 2000,
+                 bin_usec: float = 50,
+                 bin_num: int = 40):
+        """
+        :param period_msec: 周期[msec]
+        :param spin_usec: 締切の何usec前からsleepせずに待つか
+        :param async_spin_usec: wait_asyncでのspin_usec。イベントループの待ち時間の切り上げ(最大1msec)と
+                                タスク切り替えの遅れを見込み、spin_usecより1msec以上大きくする
+        :param bin_usec: ヒストグラムの刻み[usec]
+        :param bin_num: ヒストグラムの刻み数。これを超える遅れは最後の区間にまとめる
+        """
+        self._period_ns = int(period_msec * 1_000_000)
+        self._spin_ns = int(spin_usec * 1_000)
+        self._async_spin_ns = int(async_spin_usec * 1_000)
+        self._bin_ns = int(bin_usec * 1_000)
+        self._histogram = [0] * (bin_num + 1)
+        self._next_ns = None
+        self._late_ns_max = 0
+        self._late_ns_total = 0
+        self.missed = 0
+
+    def start(self):
+        self._next_ns = time.perf_counter_ns() + self._period_ns
+
+    def _remain_ns(self) -> int:
+        if self._next_ns is None:
+            self.start()
+
+        return self._next_ns - time.perf_counter_ns()
+
+    def _spin(self) -> int:
+        # 締切まで待ち、遅れを記録して次の締切へ進める
+        deadline = self._next_ns
+        while (now_ns := time.perf_counter_ns()) < deadline:
+            pass
+
+        late_ns = now_ns - deadline
+        self._histogram[min(late_ns // self._bin_ns, len(self._histogram) - 1)] += 1
+        self._late_ns_max = max(self._late_ns_max, late_ns)
+        self._late_ns_total += late_ns
+
+        # 処理が周期を超えた場合は、過ぎた締切を飛ばす
+        self._next_ns += self._period_ns
+        if now_ns >= self._next_ns:
+            skip = (now_ns - self._next_ns) // self._period_ns + 1
+            self.missed += skip
+            self._next_ns += skip * self._period_ns
+
+        return late_ns
+
+    def wait(self) -> int:
+        """
+        次の締切まで待つ。
+        :return: 締切からの遅れ[nsec]
+        """
+        remain_ns = self._remain_ns()
+        if remain_ns > self._spin_ns:
+            time.sleep((remain_ns - self._spin_ns) / 1e9)
+
+        return self._spin()
+
+    async def wait_async(self) -> int:
+        """
+        waitのasyncio版。sleep中は他のタスクを実行し、最後のasync_spin_usecだけイベントループを占有する。
+        :return: 締切からの遅れ[nsec]
+        """
+        remain_ns = self._remain_ns()
+        if remain_ns > self._async_spin_ns:
+            await asyncio.sleep((remain_ns - self._async_spin_ns) / 1e9)
+
+        return self._spin()
+
+    def histogram(self) -> list[tuple[float, int]]:
+        """
+        :return: (区間の下限[usec], 回数)のリスト
+        """
+        return [(i * self._bin_ns / 1000, cnt) for i, cnt in enumerate(self._histogram)]
+
+    def stats(self) -> dict:
+        _count = sum(self._histogram)
+        return {'count': _count,
+                'missed': self.missed,
+                'late_usec_avg': self._late_ns_total / max(_count, 1) / 1000,
+                'late_usec_max': self._late_ns_max / 1000}
+
+
 def save_image(img_path: str, img: np.array):
     cv2.imwrite(img_path, img)
 
 
+class ImageWriter:
+    """
+    画像の保存を、固定数のワーカースレッドとサイズ上限付きのキューで行う。
+    キューが満杯の場合、policy='block'は空きができるまで待ち、policy='drop'はその画像を保存しない。
+    保存が終わるまでimgを参照するため、呼び出し側は保存依頼後にimgを書き換えないこと。
+    """
+
+    def __init__(self,
+                 workers: int = 2,
+                 queue_size: int = 16,
+                 policy: str = 'block'):
+        """
+        :param workers: ワーカースレッド数
+        :param queue_size: キューの最大数
+        :param policy: キューが満杯の場合の動作。'block' or 'drop'
+        """
+        assert policy in ('block', 'drop')
+        self.policy = policy
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # closeの終了指示より後に画像を入れないよう、_closedの確認とキューへの投入をまとめて行う。
+        # 'block'でキューの空きを待つ間もワーカーが集計できるよう、集計用の_lockとは分ける
+        self._submit_lock = threading.Lock()
+        self._closed = False
+        self._metrics = {'submitted': 0,
+                         'written': 0,
+                         'dropped': 0,
+                         'errors': 0,
+                         'queue_depth_max': 0,
+                         'encode_msec_total': 0.0,
+                         'encode_msec_max': 0.0,
+                         'write_msec_total': 0.0,
+                         'write_msec_max': 0.0}
+        self.last_error = None
+
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, img_path: str, img: np.array) -> bool:
+        """
+        画像の保存を依頼する。
+        :param img_path: 保存先。拡張子で画像形式を決める
+        :param img: 画像
+        :return: キューに入れた場合True、policy='drop'で捨てた場合False
+        """
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError('ImageWriter is closed')
+
+            try:
+                if self.policy == 'block':
+                    self._queue.put((img_path, img))
+                else:
+                    self._queue.put_nowait((img_path, img))
+            except queue.Full:
+                with self._lock:
+                    self._metrics['dropped'] += 1
+                return False
+
+        with self._lock:
+            self._metrics['submitted'] += 1
+            self._metrics['queue_depth_max'] = max(self._metrics['queue_depth_max'], self._queue.qsize())
+        return True
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            img_path, img = item
+            try:
+                # エンコードとファイル書き込みの時間を分けて計測する
+                time0 = time.perf_counter()
+                ret, buf = cv2.imencode(os.path.splitext(img_path)[1], img)
+                if not ret:
+                    raise RuntimeError(f'imencode failed: {img_path}')
+
+                time1 = time.perf_counter()
+                buf.tofile(img_path)
+                time2 = time.perf_counter()
+
+                with self._lock:
+                    _encode_msec = (time1 - time0) * 1000
+                    _write_msec = (time2 - time1) * 1000
+                    self._metrics['written'] += 1
+                    self._metrics['encode_msec_total'] += _encode_msec
+                    self._metrics['encode_msec_max'] = max(self._metrics['encode_msec_max'], _encode_msec)
+                    self._metrics['write_msec_total'] += _write_msec
+                    self._metrics['write_msec_max'] = max(self._metrics['write_msec_max'], _write_msec)
+
+            except Exception as err:
+                with self._lock:
+                    self._metrics['errors'] += 1
+                    self.last_error = err
+
+    def metrics(self) -> dict:
+        """
+        :return: 依頼/保存/破棄/エラー数、現在/最大のキュー長、エンコード/書き込み時間の平均/最大[msec]
+        """
+        with self._lock:
+            _metrics = dict(self._metrics)
+
+        _written = max(_metrics['written'], 1)
+        _metrics['queue_depth'] = self._queue.qsize()
+        _metrics['encode_msec_avg'] = _metrics.pop('encode_msec_total') / _written
+        _metrics['write_msec_avg'] = _metrics.pop('write_msec_total') / _written
+
+        return _metrics
+
+    def close(self):
+        """
+        キューに残った画像を全て保存してから、ワーカースレッドを終了する。
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+
+            for _ in self._threads:
+                self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+
 def example(debug: bool = False,
-            use_asyncio: bool = True,
-            use_threading: bool = False):
+            use_writer: bool = True):
+    """
+    10msec周期で画像を保存する。
+    :param debug: 周期毎の遅れを出力するかどうか
+    :param use_writer: ImageWriterで保存するかどうか。Falseの場合は周期処理の中で保存する(比較用)
+    """
     out_dir = './out'
     if os.path.isdir(out_dir):
         shutil.rmtree(out_dir)
@@ -49,34 +287,47 @@ def example(debug: bool = False,
     img_path = '0_org.jpg'
     img = cv2.imread(img_path, cv2.IMREAD_COLOR)
 
+    # 保存が周期に間に合わない場合は、スレッドやメモリを増やさずにその画像を捨てる
+    writer = ImageWriter(workers=2, queue_size=16, policy='drop') if use_writer else None
+
     cnt = 0
-    timer = Timer()
+    scheduler = PeriodicScheduler(period_msec=10)
+    scheduler.start()
     while True:
         cnt += 1
 
         out_path = f'{out_dir}/debug_{cnt:05d}.png'
 
-        if use_asyncio:
-            loop = asyncio.get_event_loop()
-            loop.run_in_executor(None, save_image, out_path, img)
-        elif use_threading:
-            thred = threading.Thread(target=save_image, args=(out_path, img))
-            thred.start()
+        if writer is not None:
+            writer.submit(out_path, img)
         else:
             save_image(out_path, img)
 
-        timer.wait(10, dt_msec=None)
+        late_ns = scheduler.wait()
 
         if debug:
-            print(cnt, '\t', f'{timer.show() - 10:.3f}')
-
-        timer.start()
+            print(cnt, '\t', f'{late_ns / 1e6:.3f}')
 
         if cnt > 100:
+            if writer is not None:
+                writer.close()
+                print(writer.metrics())
+            print(scheduler.stats())
             return
 
 
+async def example_async(debug: bool = False):
+    scheduler = PeriodicScheduler(period_msec=10)
+    scheduler.start()
+
+    for cnt in range(100):
+        late_ns = await scheduler.wait_async()
+
+        if debug:
+            print(cnt, '\t', f'{late_ns / 1e6:.3f}')
+
+    print(scheduler.stats())
+
+
 if __name__ == '__main__':
-    example(debug=True,
-            use_asyncio=False,
-            use_threading=True)
+    example(debug=True)
@@ -1,6 +1,12 @@
 import glob
 import csv
+import hashlib
+import io
+import json
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 def csv_merge(data_dir: str = './data',
@@ -45,5 +51,592 @@ def csv_merge(data_dir: str = './data',
         fr.close()
 
 
+def _merge_files(fw,
+                 filenames: list[str],
+                 write_header: bool,
+                 batch_rows: int) -> int:
+    """
+    CSVファイル群を読み込み、開いている出力ストリームへ書き込む。
+    :param fw: 出力ストリーム
+    :param filenames: 入力ファイル名のリスト
+    :param write_header: ヘッダを出力するかどうか
+    :param batch_rows: 一度に書き込む行数
+    :return: 出力したデータ行数
+    """
+    csv_writer = csv.writer(fw, lineterminator='\n')
+
+    row_num = 0
+    batch = []
+    for filename in filenames:
+        _dir = os.path.dirname(filename)
+        _file = os.path.basename(filename)
+
+        with open(filename, 'r') as fr:
+            log = csv.reader(fr, delimiter=',', lineterminator='\n')
+
+            header = next(log, None)
+            if header is None:
+                continue
+
+            # 最初のファイルのヘッダを出力
+            if write_header:
+                csv_writer.writerow(['dir_name', 'file_name'] + header)
+                write_header = False
+
+            # データ出力。batch_rows毎にまとめて書き込む
+            for row in log:
+                batch.append([_dir, _file] + row)
+                if len(batch) >= batch_rows:
+                    csv_writer.writerows(batch)
+                    row_num += len(batch)
+                    batch.clear()
+
+    if batch:
+        csv_writer.writerows(batch)
+        row_num += len(batch)
+
+    return row_num
+
+
+def _encode_csv_file(filename: str) -> tuple[list[str] | None, str, int]:
+    """
+    CSVファイルを読み込み、ホルダ名/ファイル名を付加したデータ行をCSV文字列に変換する。
+    並列処理のワーカーで実行する。
+    :param filename: 入力ファイル名
+    :return: ヘッダ(空ファイルの場合None), データ行のCSV文字列, データ行数
+    """
+    _dir = os.path.dirname(filename)
+    _file = os.path.basename(filename)
+
+    with open(filename, 'r') as fr:
+        log = csv.reader(fr, delimiter=',', lineterminator='\n')
+
+        header = next(log, None)
+        if header is None:
+            return None, '', 0
+
+        buf = io.StringIO()
+        csv_writer = csv.writer(buf, lineterminator='\n')
+        row_num = 0
+        for row in log:
+            csv_writer.writerow([_dir, _file] + row)
+            row_num += 1
+
+    return header, buf.getvalue(), row_num
+
+
+def _iter_encoded_files(filenames: list[str],
+                        workers: int,
+                        use_thread: bool):
+    """
+    ファイル群をプールで並列にCSV文字列へ変換し、ファイル順に結果を返す。
+    未処理の結果はworkers * 2個までとし、書き込みが遅い場合は投入を待たせる。
+    :param filenames: 入力ファイル名のリスト
+    :param workers: ワーカー数
+    :param use_thread: Trueの場合スレッドプール、Falseの場合プロセスプールを使う
+    :return: _encode_csv_fileの結果のイテレータ
+    """
+    executor_cls = ThreadPoolExecutor if use_thread else ProcessPoolExecutor
+    max_pending = workers * 2
+
+    with executor_cls(max_workers=workers) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append(executor.submit(_encode_csv_file, filename))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _merge_files_parallel(fw,
+                          filenames: list[str],
+                          write_header: bool,
+                          workers: int,
+                          use_thread: bool = False) -> int:
+    """
+    _merge_filesの並列版。読込/変換をプールで行い、書き込みは呼び出し元で行う。
+    :param fw: 出力ストリーム
+    :param filenames: 入力ファイル名のリスト
+    :param write_header: ヘッダを出力するかどうか
+    :param workers: ワーカー数
+    :param use_thread: Trueの場合スレッドプール、Falseの場合プロセスプールを使う
+    :return: 出力したデータ行数
+    """
+    csv_writer = csv.writer(fw, lineterminator='\n')
+
+    row_num = 0
+    for header, text, rows in _iter_encoded_files(filenames, workers, use_thread):
+        if header is None:
+            continue
+
+        # 最初のファイルのヘッダを出力
+        if write_header:
+            csv_writer.writerow(['dir_name', 'file_name'] + header)
+            write_header = False
+
+        fw.write(text)
+        row_num += rows
+
+    return row_num
+
+
+def _find_csv_files(data_dir: str) -> list[str]:
+    """
+    data_dir以下のCSVファイルを探索する。出力順を固定するためソートして返す。
+    :param data_dir: データホルダ名
+    :return: ファイル名のリスト
+    """
+    return sorted(glob.glob(f'{data_dir}/**/*.csv', recursive=True))
+
+
+def _write_merge(fw,
+                 filenames: list[str],
+                 write_header: bool,
+                 batch_rows: int,
+                 workers: int,
+                 use_thread: bool) -> int:
+    if workers > 1:
+        return _merge_files_parallel(fw, filenames, write_header,
+                                     workers=workers, use_thread=use_thread)
+
+    return _merge_files(fw, filenames, write_header, batch_rows=batch_rows)
+
+
+def _make_stats(file_num: int, row_num: int, byte_num: int, sec: float) -> dict:
+    return {'files': file_num,
+            'rows': row_num,
+            'bytes': byte_num,
+            'sec': sec,
+            'rows_per_sec': row_num / sec if sec > 0 else 0.0,
+            'bytes_per_sec': byte_num / sec if sec > 0 else 0.0}
+
+
+def _show_speed(stats: dict) -> None:
+    _sec = stats['sec']
+    print(f"files: {stats['files']}, rows: {stats['rows']}, bytes: {stats['bytes']}, time: {_sec:.3f}[sec]")
+    print(f"{stats['rows_per_sec']:.1f}[rows/sec], {stats['bytes_per_sec'] / 1024 / 1024:.2f}[MB/sec]")
+
+
+def csv_merge_stream(data_dir: str = './data',
+                     merge_file: str = 'merge.csv',
+                     buffer_size: int = 1024 * 1024,
+                     batch_rows: int = 10000,
+                     workers: int = 1,
+                     use_thread: bool = False,
+                     verbose: bool = True) -> dict:
+    """
+    csv_mergeのストリーミング版。
+    出力ファイルを一度だけ開き、大きな書き込みバッファを介して行をまとめて書き込む。
+    :param data_dir: データホルダ名
+    :param merge_file: マージファイル名
+    :param buffer_size: 出力ファイルの書き込みバッファサイズ[byte]
+    :param batch_rows: 一度に書き込む行数
+    :param workers: 2以上の場合、ファイルの読込/変換を並列に行う。出力はファイル名順
+    :param use_thread: 並列処理でスレッドプールを使うかどうか。Falseの場合プロセスプール
+    :param verbose: 処理速度を出力するかどうか
+    :return: 処理結果(ファイル数/行数/バイト数/処理時間/行数毎秒/バイト毎秒)
+    """
+    start_time = time.perf_counter()
+
+    # ファイル探索
+    filenames = _find_csv_files(data_dir)
+
+    with open(merge_file, 'w', buffering=buffer_size) as fw:
+        row_num = _write_merge(fw, filenames, True, batch_rows, workers, use_thread)
+
+    stats = _make_stats(len(filenames), row_num, os.path.getsize(merge_file),
+                        time.perf_counter() - start_time)
+
+    if verbose:
+        _show_speed(stats)
+
+    return stats
+
+
+def _file_hash(filename: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    ファイル内容のハッシュ値を計算する。
+    :param filename: ファイル名
+    :param chunk_size: 一度に読み込むサイズ[byte]
+    :return: ハッシュ値(16進文字列)
+    """
+    _hash = hashlib.sha1()
+    with open(filename, 'rb') as fr:
+        while chunk := fr.read(chunk_size):
+            _hash.update(chunk)
+
+    return _hash.hexdigest()
+
+
+def _load_manifest(manifest_file: str) -> tuple[dict, int | None]:
+    """
+    マニフェストを読み込む。
+    :param manifest_file: マニフェストファイル名
+    :return: マージ済みファイルの情報, 記録時点のマージファイルサイズ(不明な場合None)
+    """
+    if not os.path.isfile(manifest_file):
+        return {}, None
+
+    with open(manifest_file, 'r', encoding='utf-8') as fr:
+        manifest = json.load(fr)
+
+    # マージファイルサイズを記録していない形式の場合は、作り直させる
+    if 'files' not in manifest:
+        return {}, None
+
+    return manifest['files'], manifest.get('merge_size')
+
+
+def _save_manifest(manifest_file: str, manifest: dict, merge_size: int) -> None:
+    # 書き込み途中で中断しても壊れないよう、一時ファイル経由で置き換える
+    tmp_file = f'{manifest_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fw:
+        json.dump({'merge_size': merge_size, 'files': manifest}, fw, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+def csv_merge_incremental(data_dir: str = './data',
+                          merge_file: str = 'merge.csv',
+                          manifest_file: str | None = None,
+                          buffer_size: int = 1024 * 1024,
+                          batch_rows: int = 10000,
+                          workers: int = 1,
+                          use_thread: bool = False,
+                          verbose: bool = True) -> dict:
+    """
+    csv_mergeの差分更新版。
+    マージ済みファイルのパス/サイズ/更新時刻/ハッシュ値をマニフェストに記録し、
+    新規ファイルのみをマージファイルへ追記する。
+    既存ファイルの変更/削除があった場合は、マージファイルを作り直す。
+    マニフェストには更新完了時のマージファイルサイズも記録し、追記中に中断した場合は
+    次回実行時にそのサイズまで切り詰めてから追記し直す。
+    :param data_dir: データホルダ名
+    :param merge_file: マージファイル名
+    :param manifest_file: マニフェストファイル名。Noneの場合、merge_file + '.manifest.json'
+    :param buffer_size: 出力ファイルの書き込みバッファサイズ[byte]
+    :param batch_rows: 一度に書き込む行数
+    :param workers: 2以上の場合、ファイルの読込/変換を並列に行う
+    :param use_thread: 並列処理でスレッドプールを使うかどうか。Falseの場合プロセスプール
+    :param verbose: 処理速度を出力するかどうか
+    :return: 処理結果(csv_merge_streamの項目 + 'rebuild': 作り直したかどうか)
+    """
+    start_time = time.perf_counter()
+
+    if manifest_file is None:
+        manifest_file = f'{merge_file}.manifest.json'
+
+    # マージファイルが無い場合は、マニフェストも無効
+    manifest, merge_size = _load_manifest(manifest_file) if os.path.isfile(merge_file) else ({}, None)
+    rebuild = not manifest or merge_size is None
+
+    # 前回の追記が中断された場合、マニフェスト記録時のサイズまで切り詰める。
+    # 記録より小さい場合はマージファイルが壊れているため作り直す
+    if not rebuild:
+        _size = os.path.getsize(merge_file)
+        if _size > merge_size:
+            with open(merge_file, 'r+b') as fw:
+                fw.truncate(merge_size)
+        elif _size < merge_size:
+            rebuild = True
+
+    # 前回からの変更を確認。サイズ/更新時刻が同じファイルはハッシュ計算を省略する
+    filenames = _find_csv_files(data_dir)
+    new_manifest = {}
+    new_files = []
+    for filename in filenames:
+        _stat = os.stat(filename)
+        entry = manifest.get(filename)
+        if entry is not None and entry['size'] == _stat.st_size and entry['mtime'] == _stat.st_mtime_ns:
+            new_manifest[filename] = entry
+            continue
+
+        _hash = _file_hash(filename)
+        if entry is None:
+            new_files.append(filename)
+        elif entry['hash'] != _hash:
+            rebuild = True
+
+        new_manifest[filename] = {'size': _stat.st_size,
+                                  'mtime': _stat.st_mtime_ns,
+                                  'hash': _hash}
+
+    # 削除されたファイルがあれば作り直す
+    if any(filename not in new_manifest for filename in manifest):
+        rebuild = True
+
+    if rebuild:
+        # 作り直しの途中で中断した場合に、次回も作り直すようマニフェストを消しておく
+        if os.path.isfile(manifest_file):
+            os.remove(manifest_file)
+
+        write_files = filenames
+        size_before = 0
+        with open(merge_file, 'w', buffering=buffer_size) as fw:
+            row_num = _write_merge(fw, write_files, True, batch_rows, workers, use_thread)
+    else:
+        write_files = new_files
+        size_before = os.path.getsize(merge_file)
+        with open(merge_file, 'a', buffering=buffer_size) as fw:
+            row_num = _write_merge(fw, write_files, size_before == 0, batch_rows, workers, use_thread)
+
+    # マージファイルの出力後にマニフェストを更新する
+    _save_manifest(manifest_file, new_manifest, os.path.getsize(merge_file))
+
+    stats = _make_stats(len(write_files), row_num, os.path.getsize(merge_file) - size_before,
+                        time.perf_counter() - start_time)
+    stats['rebuild'] = rebuild
+
+    if verbose:
+        print(f"rebuild: {rebuild}")
+        _show_speed(stats)
+
+    return stats
+
+
+def _read_header(filename: str) -> list[str] | None:
+    with open(filename, 'r') as fr:
+        return next(csv.reader(fr, delimiter=',', lineterminator='\n'), None)
+
+
+def _union_columns(filenames: list[str]) -> list[str]:
+    """
+    全ファイルのヘッダを走査し、出現順に列名の和集合を作る。
+    :param filenames: 入力ファイル名のリスト
+    :return: 列名のリスト
+    """
+    columns = {}
+    for filename in filenames:
+        for column in _read_header(filename) or []:
+            columns.setdefault(column, None)
+
+    return list(columns)
+
+
+def _merge_files_schema(fw,
+                        filenames: list[str],
+                        columns: list[str],
+                        batch_rows: int) -> int:
+    """
+    各ファイルの列を列名でcolumnsの位置に対応付けて出力する。存在しない列は空欄とする。
+    :param fw: 出力ストリーム
+    :param filenames: 入力ファイル名のリスト
+    :param columns: 出力する列名のリスト
+    :param batch_rows: 一度に書き込む行数
+    :return: 出力したデータ行数
+    """
+    csv_writer = csv.writer(fw, lineterminator='\n')
+    csv_writer.writerow(['dir_name', 'file_name'] + columns)
+
+    row_num = 0
+    batch = []
+    for filename in filenames:
+        _dir = os.path.dirname(filename)
+        _file = os.path.basename(filename)
+
+        with open(filename, 'r') as fr:
+            log = csv.reader(fr, delimiter=',', lineterminator='\n')
+
+            header = next(log, None)
+            if header is None:
+                continue
+
+            # 列名 -> 元ファイルの列番号。列名が重複する場合は先頭の列を使う
+            positions = {}
+            for i, column in enumerate(header):
+                positions.setdefault(column, i)
+            col_idx = [positions.get(column) for column in columns]
+
+            for row in log:
+                _row = [row[i] if i is not None and i < len(row) else '' for i in col_idx]
+                batch.append([_dir, _file] + _row)
+                if len(batch) >= batch_rows:
+                    csv_writer.writerows(batch)
+                    row_num += len(batch)
+                    batch.clear()
+
+    if batch:
+        csv_writer.writerows(batch)
+        row_num += len(batch)
+
+    return row_num
+
+
+def _unify_type(pa, types: list):
+    """
+    ファイル毎に推定した列の型を1つにまとめる。
+    型が一致すればその型、数値のみならfloat64、それ以外は文字列とする。
+    """
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.string()
+
+    if all(t == types[0] for t in types):
+        return types[0]
+
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+
+    return pa.string()
+
+
+def _csv_read_options(pa_csv, header: list[str]) -> tuple:
+    """
+    重複した列名は、CSV出力(_merge_files_schema)と同じく先頭の列のみ読み込む。
+    2つ目以降の列には仮の列名を付け、読込対象から外す。
+    :param header: ヘッダ
+    :return: (ReadOptions, 読み込む列名のリスト)
+    """
+    column_names = []
+    columns = {}
+    for i, column in enumerate(header):
+        if column in columns:
+            column_names.append(f'{column}\0{i}')
+        else:
+            column_names.append(column)
+            columns[column] = None
+
+    return pa_csv.ReadOptions(column_names=column_names, skip_rows=1), list(columns)
+
+
+def _infer_csv_schema(pa, pa_csv, filename: str):
+    """
+    CSVファイル全体から列の型を推定する。
+    ストリーム読込は先頭ブロックで型を決めるため、後方のブロックで変換に失敗した場合は
+    ファイル全体を読み込んで推定し直す。
+    :param filename: ファイル名
+    :return: スキーマ
+    """
+    read_options, columns = _csv_read_options(pa_csv, _read_header(filename))
+    convert_options = pa_csv.ConvertOptions(include_columns=columns)
+    try:
+        with pa_csv.open_csv(filename, read_options=read_options, convert_options=convert_options) as reader:
+            schema = reader.schema
+            for _ in reader:
+                pass
+        return schema
+    except pa.ArrowInvalid:
+        return pa_csv.read_csv(filename, read_options=read_options, convert_options=convert_options).schema
+
+
+def _merge_files_arrow(out_file: str,
+                       filenames: list[str],
+                       output_format: str) -> int:
+    """
+    CSVファイル群を型付きの列形式(Parquet/Arrow IPC)で出力する。
+    1回目の走査で各ファイル全体から型を推定して和集合のスキーマを作り、
+    2回目の走査でファイル毎に読み込んでスキーマに合わせて書き込む。
+    :param out_file: 出力ファイル名
+    :param filenames: 入力ファイル名のリスト
+    :param output_format: 'parquet' or 'arrow'
+    :return: 出力したデータ行数
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    filenames = [filename for filename in filenames if _read_header(filename)]
+
+    # 列毎の型を推定
+    column_types = {}
+    for filename in filenames:
+        for field in _infer_csv_schema(pa, pa_csv, filename):
+            column_types.setdefault(field.name, []).append(field.type)
+
+    fields = [pa.field('dir_name', pa.string()), pa.field('file_name', pa.string())]
+    fields += [pa.field(name, _unify_type(pa, types)) for name, types in column_types.items()]
+    schema = pa.schema(fields)
+
+    if output_format == 'parquet':
+        writer = pq.ParquetWriter(out_file, schema)
+    else:
+        writer = pa.ipc.new_file(out_file, schema)
+
+    row_num = 0
+    with writer:
+        for filename in filenames:
+            read_options, columns = _csv_read_options(pa_csv, _read_header(filename))
+            convert_options = pa_csv.ConvertOptions(
+                include_columns=columns,
+                column_types={name: schema.field(name).type for name in columns})
+            table = pa_csv.read_csv(filename, read_options=read_options, convert_options=convert_options)
+
+            n = table.num_rows
+            arrays = [pa.array([os.path.dirname(filename)] * n, pa.string()),
+                      pa.array([os.path.basename(filename)] * n, pa.string())]
+            for field in fields[2:]:
+                if field.name in table.column_names:
+                    arrays.append(table.column(field.name))
+                else:
+                    arrays.append(pa.nulls(n, field.type))
+
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            row_num += n
+
+    return row_num
+
+
+def csv_merge_schema(data_dir: str = './data',
+                     merge_file: str = 'merge.csv',
+                     output_format: str = 'csv',
+                     buffer_size: int = 1024 * 1024,
+                     batch_rows: int = 10000,
+                     verbose: bool = True) -> dict:
+    """
+    ヘッダの異なるCSVファイルをマージする。
+    全ファイルのヘッダから列名の和集合を作り、各ファイルの列を列名で対応付けて出力する。
+    output_formatに'parquet'/'arrow'を指定すると、型付きの列形式で出力する(pyarrowが必要)。
+    :param data_dir: データホルダ名
+    :param merge_file: マージファイル名
+    :param output_format: 'csv', 'parquet', 'arrow'(Arrow IPC)のいずれか
+    :param buffer_size: CSV出力時の書き込みバッファサイズ[byte]
+    :param batch_rows: CSV出力時に一度に書き込む行数
+    :param verbose: 処理速度を出力するかどうか
+    :return: 処理結果(csv_merge_streamと同じ項目)
+    """
+    if output_format not in ('csv', 'parquet', 'arrow'):
+        raise ValueError(f'illegal output_format: {output_format}')
+
+    start_time = time.perf_counter()
+
+    # ファイル探索
+    filenames = _find_csv_files(data_dir)
+
+    if output_format == 'csv':
+        columns = _union_columns(filenames)
+        with open(merge_file, 'w', buffering=buffer_size) as fw:
+            row_num = _merge_files_schema(fw, filenames, columns, batch_rows)
+    else:
+        row_num = _merge_files_arrow(merge_file, filenames, output_format)
+
+    stats = _make_stats(len(filenames), row_num, os.path.getsize(merge_file),
+                        time.perf_counter() - start_time)
+
+    if verbose:
+        _show_speed(stats)
+
+    return stats
+
+
+def compare_csv_merge(data_dir: str = './data',
+                      buffer_size: int = 1024 * 1024) -> None:
+    """
+    同一データに対してcsv_merge/csv_merge_streamの処理時間を比較する。
+    :param data_dir: データホルダ名
+    :param buffer_size: csv_merge_streamの書き込みバッファサイズ[byte]
+    :return:
+    """
+    start_time = time.perf_counter()
+    csv_merge(data_dir, merge_file='merge_org.csv')
+    _sec = time.perf_counter() - start_time
+    print(f'csv_merge: {_sec:.3f}[sec]')
+
+    stats = csv_merge_stream(data_dir, merge_file='merge_stream.csv',
+                             buffer_size=buffer_size, verbose=False)
+    print(f"csv_merge_stream: {stats['sec']:.3f}[sec]")
+    _show_speed(stats)
+
+
 if __name__ == '__main__':
     csv_merge()
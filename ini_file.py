@@ -1,8 +1,12 @@
 import os
+import re
+import stat
+import threading
 import configparser
 from dataclasses import dataclass
 from logging import getLogger, Logger, NullHandler
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Callable, Mapping
 
 
 @dataclass(frozen=True)
@@ -14,6 +18,34 @@ class DefaultParams:
     param_type: str
 
 
+def _to_bool(val: str) -> bool:
+    _val = val.strip().lower()
+    if _val not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError(f'not a boolean: {val}')
+
+    return configparser.ConfigParser.BOOLEAN_STATES[_val]
+
+
+def _to_list(val: str) -> list[str]:
+    # カンマ区切りの文字列のリスト
+    return [_v.strip() for _v in val.split(',') if _v.strip()]
+
+
+def _to_ini_str(val: Any) -> str:
+    if isinstance(val, (list, tuple)):
+        return ', '.join(str(_v) for _v in val)
+
+    return str(val)
+
+
+# param_type -> ini-fileの文字列から値への変換関数
+_CONVERTERS = {'float': float,
+               'int': int,
+               'str': str,
+               'bool': _to_bool,
+               'list': _to_list}
+
+
 class IniFile:
     def __init__(self,
                  filename: str,
@@ -21,6 +53,27 @@ class IniFile:
         self.filename = filename
         self._default_params_list: list[DefaultParams] = []
 
+        # パラメータ定義を変換関数のリストにしたもの。append_paramで作り直す
+        self._compiled_params: list[tuple[str, str, str, Any]] | None = None
+
+        # 読み込み結果のキャッシュ。ini-fileの更新時刻とサイズが同じなら再利用する。
+        # 読み込み毎に新しい読み取り専用のdictに差し替えるため、参照側はロック不要
+        self._cache_key: tuple | None = None
+        self._cache_params: Mapping[str, Any] = MappingProxyType({})
+
+        # 各パラメータの値の出所('default', 'file:{ファイル名}', 'env:{環境変数名}')
+        self._param_sources: Mapping[str, str] = MappingProxyType({})
+
+        # load_layeredの引数(ini-fileのリスト, 環境変数名の接頭辞)。監視時に同じ条件で読み込み直す。
+        # load_inifileで読み込んだ場合はNone
+        self._layered: tuple[list[str], str | None] | None = None
+
+        # ファイル監視
+        self._reload_lock = threading.Lock()
+        self._reload_callbacks: list[Callable[[Mapping[str, Any]], None]] = []
+        self._watch_stop = threading.Event()
+        self._watch_thread: threading.Thread | None = None
+
         if logger is not None:
             self._logger = logger
         else:
@@ -32,43 +85,263 @@ class IniFile:
             self._logger.error(_msg)
             raise ValueError(_msg)
 
-    def load_inifile(self) -> None:
-        self._logger.info(f'load inifile')
+    def _compile_params(self) -> list[tuple[str, str, str, Any]]:
+        if self._compiled_params is not None:
+            return self._compiled_params
 
-        if not os.path.isfile(self.filename):
-            _msg = f'No ini-file: {self.filename}'
-            self._logger.error(_msg)
-            raise FileNotFoundError(_msg)
+        compiled = []
+        for _params in self._default_params_list:
+            if _params.param_type not in _CONVERTERS:
+                _msg = f'load_inifile: illegal type: {_params.param_name}'
+                self._logger.error(_msg)
+                raise ValueError(_msg)
+
+            compiled.append((_params.param_name, _params.config_section, _params.config_key,
+                             _CONVERTERS[_params.param_type]))
 
+        self._compiled_params = compiled
+        return compiled
+
+    def _read_config(self, filename: str) -> configparser.ConfigParser:
+        # 書式の誤り(セクションの重複など)は、型変換の失敗と同じくValueErrorとする
         _config = configparser.ConfigParser()
         _config.optionxform = str
-        _config.read(self.filename)
+        try:
+            _config.read(filename)
+        except configparser.Error as err:
+            self._logger.error(f'load_inifile: {filename}')
+            self._logger.error(f'load_inifile: {err}')
+            raise ValueError(err)
 
-        for _params in self._default_params_list:
-            try:
-                _val = _config.get(_params.config_section, _params.config_key)
+        return _config
 
-                if _params.param_type == 'float':
-                    _val = float(_val)
-                elif _params.param_type == 'str':
-                    pass
-                else:
-                    _msg = f'load_inifile: illegal type: {_params.param_name}'
-                    self._logger.error(_msg)
-                    raise ValueError(_msg)
+    def _parse_inifile(self) -> dict[str, Any]:
+        _config = self._read_config(self.filename)
 
+        params = {}
+        for _name, _section, _key, _converter in self._compile_params():
+            try:
+                params[_name] = _converter(_config.get(_section, _key))
             except Exception as err:
-                self._logger.error(f'load_inifile: {_params.param_name}')
+                self._logger.error(f'load_inifile: {_name}')
                 self._logger.error(f'load_inifile: {err}')
                 raise ValueError(err)
 
-            setattr(self, _params.param_name, _val)
+        return params
+
+    def _stat_key(self, log_error: bool = True) -> tuple[int, int]:
+        try:
+            _stat = os.stat(self.filename)
+        except OSError:
+            _stat = None
+
+        if _stat is None or not stat.S_ISREG(_stat.st_mode):
+            _msg = f'No ini-file: {self.filename}'
+            if log_error:
+                self._logger.error(_msg)
+            raise FileNotFoundError(_msg)
+
+        return _stat.st_mtime_ns, _stat.st_size
+
+    def _reload(self, cache_key: tuple[int, int]) -> None:
+        # 全パラメータの変換に成功した場合のみ、読み込み結果を差し替える
+        with self._reload_lock:
+            self._logger.info(f'load inifile')
+            params = self._parse_inifile()
+            self._set_params(params, {_name: f'file:{self.filename}' for _name in params}, cache_key)
+
+    def _set_params(self,
+                    params: dict[str, Any],
+                    sources: dict[str, str],
+                    cache_key: tuple | None) -> None:
+        # list型はtupleにして、読み込み結果を変更できないようにする
+        params = {_name: tuple(_val) if isinstance(_val, list) else _val
+                  for _name, _val in params.items()}
+        self._cache_params = MappingProxyType(params)
+        self._param_sources = MappingProxyType(sources)
+        self._cache_key = cache_key
+
+    def _apply_params(self) -> None:
+        for _name, _val in self._cache_params.items():
+            if isinstance(_val, tuple):
+                _val = list(_val)
+            setattr(self, _name, _val)
+
+    @property
+    def params(self) -> Mapping[str, Any]:
+        """
+        最後に読み込んだパラメータ(読み取り専用、list型はtuple)。
+        監視中に別スレッドで更新されても、取得したものは全パラメータが同じ読み込み時点の値となる
+        """
+        return self._cache_params
+
+    @property
+    def param_sources(self) -> Mapping[str, str]:
+        """
+        paramsの各値の出所。'default', 'file:{ファイル名}', 'env:{環境変数名}'のいずれか
+        """
+        return self._param_sources
+
+    def load_layered(self,
+                     filenames: list[str] | None = None,
+                     env_prefix: str | None = None) -> None:
+        """
+        パラメータの既定値を、ini-file(複数)、環境変数の順に上書きして読み込む。
+        各値は最後に1度だけ型変換し、どこから来た値かをparam_sourcesに記録する。
+        既定値もparam_typeの型に変換するため、どの層の値でもparamsの型は同じになる。
+        ini-fileに無いパラメータは、前の層の値のままとする。
+        :param filenames: 読み込むini-fileのリスト。後のファイルが優先。Noneの場合はfilenameのみ。
+                          存在しないファイルは読み飛ばす
+        :param env_prefix: 環境変数名の接頭辞。'{env_prefix}{セクション}_{キー}'(英数字以外は'_'、大文字)の
+                           環境変数で上書きする。Noneの場合は環境変数を使わない
+        :return:
+        """
+        if filenames is None:
+            filenames = [self.filename]
+
+        self._layered = (list(filenames), env_prefix)
+        self._reload_layered(self._layered_key())
+        self._apply_params()
+
+    def _layered_key(self) -> tuple:
+        # load_layeredの各ini-fileの更新時刻とサイズ。存在しないファイルはNone
+        keys = []
+        for _filename in self._layered[0]:
+            try:
+                _stat = os.stat(_filename)
+            except OSError:
+                keys.append(None)
+                continue
+            keys.append((_stat.st_mtime_ns, _stat.st_size))
+
+        return tuple(keys)
+
+    def _reload_layered(self, cache_key: tuple) -> None:
+        # 全パラメータの変換に成功した場合のみ、読み込み結果を差し替える
+        filenames, env_prefix = self._layered
+        self._logger.info(f'load layered params')
+
+        # _compile_paramsは_default_params_listと同じ順
+        layers = list(zip(self._default_params_list, self._compile_params()))
+
+        # 既定値。remake_inifileで書き出した場合と同じ文字列にし、ini-fileの値と同じく型変換する
+        values = {_params.param_name: _to_ini_str(_params.default_val) for _params, _ in layers}
+        sources = {_params.param_name: 'default' for _params, _ in layers}
+
+        # ini-file
+        for _filename in filenames:
+            if not os.path.isfile(_filename):
+                self._logger.warning(f'load_layered: no ini-file: {_filename}')
+                continue
+
+            _config = self._read_config(_filename)
+
+            for _params, (_name, _section, _key, _) in layers:
+                if _config.has_option(_section, _key):
+                    values[_name] = _config.get(_section, _key)
+                    sources[_name] = f'file:{_filename}'
+
+        # 環境変数
+        if env_prefix is not None:
+            for _params, (_name, _section, _key, _) in layers:
+                _env_name = re.sub(r'\W', '_', f'{env_prefix}{_section}_{_key}').upper()
+                if _env_name in os.environ:
+                    values[_name] = os.environ[_env_name]
+                    sources[_name] = f'env:{_env_name}'
+
+        # 既定値/ini-file/環境変数の値(文字列)を型変換
+        for _params, (_name, _section, _key, _converter) in layers:
+            try:
+                values[_name] = _converter(values[_name])
+            except Exception as err:
+                self._logger.error(f'load_layered: {_name} ({sources[_name]})')
+                self._logger.error(f'load_layered: {err}')
+                raise ValueError(err)
+
+        with self._reload_lock:
+            self._set_params(values, sources, cache_key)
+
+    def load_inifile(self) -> None:
+        # ini-fileが更新されていなければ、前回の読み込み結果を使う
+        cache_key = self._stat_key()
+        if self._layered is not None or cache_key != self._cache_key:
+            self._layered = None
+            self._reload(cache_key)
+
+        self._apply_params()
+
+    def add_reload_callback(self, callback: Callable[[Mapping[str, Any]], None]) -> None:
+        """
+        :param callback: 監視中にini-fileを読み込み直した時に、新しいparamsを引数に呼ばれる
+        """
+        self._reload_callbacks.append(callback)
+
+    def start_watch(self, interval: float = 1.0) -> None:
+        """
+        ini-fileの更新時刻/サイズをバックグラウンドのスレッドでinterval秒毎に確認し、変更があれば読み込み直す。
+        load_layeredで読み込んだ場合は、いずれかのini-fileの変更(作成/削除を含む)で同じ条件のまま読み込み直す。
+        読み込みに失敗した場合は、前回の読み込み結果を維持する。
+        属性は1つずつ更新するため、全パラメータを同じ時点の値で参照する場合はparamsを使う。
+        :param interval: 確認間隔[sec]
+        """
+        if self._watch_thread is not None:
+            return
+
+        self._watch_stop.clear()
+        self._watch_thread = threading.Thread(target=self._watch_loop, args=(interval,), daemon=True)
+        self._watch_thread.start()
+
+    def stop_watch(self) -> None:
+        if self._watch_thread is None:
+            return
+
+        self._watch_stop.set()
+        self._watch_thread.join()
+        self._watch_thread = None
+
+    def _watch_loop(self, interval: float) -> None:
+        # 読み込みに失敗したファイルは、変更されるまで再試行しない
+        error_key = None
+        missing = False
+        while not self._watch_stop.wait(interval):
+            if self._layered is not None:
+                cache_key = self._layered_key()
+                reload = self._reload_layered
+            else:
+                try:
+                    cache_key = self._stat_key(log_error=not missing)
+                except FileNotFoundError:
+                    missing = True
+                    continue
+                missing = False
+                reload = self._reload
+
+            if cache_key == self._cache_key or cache_key == error_key:
+                continue
+
+            try:
+                reload(cache_key)
+            except ValueError:
+                error_key = cache_key
+                continue
+            except Exception as err:
+                # 想定外のエラーでも監視は止めない
+                self._logger.error(f'reload: {err}')
+                error_key = cache_key
+                continue
+
+            self._apply_params()
+            for callback in self._reload_callbacks:
+                try:
+                    callback(self._cache_params)
+                except Exception as err:
+                    self._logger.error(f'reload callback: {err}')
 
     def set_default_params(self) -> None:
         self._logger.info(f'set default-params')
 
         for _params in self._default_params_list:
-            if _params.param_type not in ['float', 'str']:
+            if _params.param_type not in _CONVERTERS:
                 _msg = f'illegal type: {_params.param_name}'
                 self._logger.error(_msg)
                 raise ValueError(_msg)
@@ -80,6 +353,8 @@ class IniFile:
             _val = getattr(self, _params.param_name, None)
 
             _msg = f'{_params.param_name} = {_val}'
+            if _params.param_name in self._param_sources:
+                _msg += f' ({self._param_sources[_params.param_name]})'
             self._logger.info(_msg)
 
     def remake_inifile(self,
@@ -99,7 +374,7 @@ class IniFile:
             else:
                 _val = getattr(self, _params.param_name, _params.default_val)
 
-            _config.set(_params.config_section, _params.config_key, str(_val))
+            _config.set(_params.config_section, _params.config_key, _to_ini_str(_val))
 
         with open(inifile, 'w') as fw:
             _config.write(fw)
@@ -108,8 +383,11 @@ class IniFile:
                      param_name: str,
                      config_section: str,
                      config_key: str,
-                     default: str | float,
+                     default: str | float | int | bool | list,
                      param_type: str):
+        """
+        :param param_type: 'float', 'int', 'str', 'bool', 'list'(カンマ区切りの文字列のリスト)のいずれか
+        """
 
         _param = DefaultParams(param_name=param_name,
                                config_section=config_section,
@@ -123,6 +401,8 @@ class IniFile:
             raise ValueError(msg)
 
         self._default_params_list.append(_param)
+        self._compiled_params = None
+        self._cache_key = None
 
 
 class ExampleIniFile(IniFile):
@@ -1,8 +1,18 @@
 import os
+import copy
 import time
 import datetime
+import json
+import gzip
 import logging
-from logging import (getLogger, Logger, Formatter,
+import multiprocessing
+import queue
+import re
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import (getLogger, Logger, Formatter, LogRecord,
                      FileHandler, StreamHandler, handlers,
                      DEBUG, INFO, WARNING, ERROR, CRITICAL)
 
@@ -12,56 +22,373 @@ class CustomFileHandler(logging.Handler):
                  log_dir='./log',
                  base_name='app.log',
                  rotation='day',
-                 encoding='utf-8'):
+                 encoding='utf-8',
+                 flush_records=1,
+                 flush_bytes=0,
+                 flush_interval=0.0,
+                 max_bytes=0,
+                 compress=None,
+                 backup_count=0,
+                 max_total_bytes=0):
+        """
+        ファイルのflushは、以下のいずれかを満たした時点で行う。ERROR以上のログは常にflushする。
+        :param flush_records: 未flushのログ数がこの値以上
+        :param flush_bytes: 未flushの書き込みサイズ(文字数で概算)がこの値以上。0の場合は使わない
+        :param flush_interval: 前回のflushからの経過時間[sec]がこの値以上。0の場合は使わない。
+                               未flushのログがある間はタイマーを動かし、次のログが来なくてもflushする
+
+        rotationの時刻による切り替えに加え、ファイルサイズでも切り替える。
+        切り替えたファイルの圧縮と古いファイルの削除は、バックグラウンドのスレッドで行う。
+        :param max_bytes: ファイルサイズ[byte]がこの値以上になれば、'{ファイル名}.{番号}'へ移して切り替える。
+                          flush時に判定する。0の場合は使わない
+        :param compress: 切り替えたファイルの圧縮形式。'gzip', 'zstd'(zstandardが必要), None(圧縮しない)
+        :param backup_count: 残す過去ファイル数。0の場合は制限しない
+        :param max_total_bytes: 現在のファイルを含む合計サイズ[byte]の上限。0の場合は制限しない。
+                                backup_countと同じく、ファイルの切り替え時に判定する
+        """
 
         super().__init__()
         self.log_dir = log_dir
         self.base_name = base_name
         self.rotation = rotation
         self.encoding = encoding
+        self.flush_records = flush_records
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.backup_count = backup_count
+        self.max_total_bytes = max_total_bytes
 
         assert self.rotation in ('day', 'month')
+        assert self.compress in (None, 'gzip', 'zstd')
+        if self.compress == 'zstd':
+            import zstandard  # noqa: F401
+
+        # 圧縮待ち/圧縮中のファイル。保存数の判定には含めるが、削除はしない
+        self._archive_pending = set()
+        self._archiver = None
+        if self.compress or self.backup_count or self.max_total_bytes:
+            self._archiver = ThreadPoolExecutor(max_workers=1)
 
         os.makedirs(self.log_dir, exist_ok=True)
         self.current_time_key = None
         self.stream = None
+        self._next_rollover = 0.0
+        self._pending_records = 0
+        self._pending_bytes = 0
+        self._last_flush = time.time()
+        self._flush_timer = None
         self._update_logfile()
 
-    def _get_time_key(self):
-        now = datetime.datetime.now()
+    def _get_time_key(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
         if self.rotation == 'day':
             return now.strftime('%Y%m%d')
         elif self.rotation == 'month':
             return now.strftime('%Y%m')
 
+    def _get_next_rollover(self, now):
+        # 次にファイルを切り替える時刻(epoch秒)
+        if self.rotation == 'day':
+            next_time = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        else:
+            next_time = datetime.datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        return next_time.timestamp()
+
     def _get_logfile_path(self, time_key):
         filename = f"{time_key}_{self.base_name}"
         return os.path.join(self.log_dir, filename)
 
     def _update_logfile(self):
-        time_key = self._get_time_key()
+        now = datetime.datetime.now()
+        self._next_rollover = self._get_next_rollover(now)
+
+        time_key = self._get_time_key(now)
         if self.current_time_key != time_key:
             if self.stream:
                 self.stream.close()
+                self._archive(self.stream.name)
             self.current_time_key = time_key
             log_path = self._get_logfile_path(time_key)
             self.stream = open(log_path, mode='a', encoding=self.encoding)
+            self._pending_records = 0
+            self._pending_bytes = 0
+
+    def _flush_stream(self, now):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        self.stream.flush()
+        self._pending_records = 0
+        self._pending_bytes = 0
+        self._last_flush = now
+
+        if self.max_bytes and os.fstat(self.stream.fileno()).st_size >= self.max_bytes:
+            self._rollover_size()
+
+    def _rollover_size(self):
+        # 現在のファイルを既存の最大番号 + 1のファイル名へ移し、新しいファイルを開く
+        log_path = self.stream.name
+        self.stream.close()
+
+        prefix = f'{os.path.basename(log_path)}.'
+        index = 1
+        for name in os.listdir(self.log_dir):
+            _index = name[len(prefix):].split('.')[0]
+            if name.startswith(prefix) and _index.isdigit():
+                index = max(index, int(_index) + 1)
+        os.rename(log_path, f'{log_path}.{index}')
+        self._archive(f'{log_path}.{index}')
+
+        self.stream = open(log_path, mode='a', encoding=self.encoding)
+
+    def _archive(self, log_path):
+        if self._archiver is not None:
+            self._archive_pending.add(os.path.abspath(log_path))
+            self._archiver.submit(self._archive_file, log_path)
+
+    def _archive_file(self, log_path):
+        # バックグラウンドのスレッドで実行する
+        try:
+            if self.compress == 'gzip':
+                with open(log_path, 'rb') as fr, gzip.open(f'{log_path}.gz', 'wb') as fw:
+                    shutil.copyfileobj(fr, fw)
+                os.remove(log_path)
+            elif self.compress == 'zstd':
+                import zstandard
+                with open(log_path, 'rb') as fr, open(f'{log_path}.zst', 'wb') as fw:
+                    zstandard.ZstdCompressor().copy_stream(fr, fw)
+                os.remove(log_path)
+            self._archive_pending.discard(os.path.abspath(log_path))
+
+            self._apply_retention()
+        except Exception as err:
+            self._archive_pending.discard(os.path.abspath(log_path))
+            # Futureの中で消えないよう、handleErrorと同じく標準エラー出力へ出力する
+            if logging.raiseExceptions and sys.stderr:
+                sys.stderr.write(f'CustomFileHandler: archive error: {log_path}: {err!r}\n')
+
+    def _apply_retention(self):
+        # 過去ファイルを切り替えの古い順(時刻, 番号の順)に削除する。現在のファイルと圧縮待ちのファイルは削除しない
+        current_path = os.path.abspath(self._get_logfile_path(self.current_time_key))
+
+        # '{time_key}_{base_name}'に番号/圧縮の拡張子が付いたもののみ対象とし、他のロガーのファイルは除く
+        key_len = 8 if self.rotation == 'day' else 6
+        pattern = re.compile(rf'(\d{{{key_len}}})_{re.escape(self.base_name)}(?:\.(\d+))?(\.gz|\.zst)?')
+
+        old_files = []
+        total_bytes = 0
+        for entry in os.scandir(self.log_dir):
+            match = pattern.fullmatch(entry.name)
+            if match is None:
+                continue
+
+            _stat = entry.stat()
+            total_bytes += _stat.st_size
+
+            path = os.path.abspath(entry.path)
+            raw_path = path[:len(path) - len(match.group(3))] if match.group(3) else path
+            if path == current_path:
+                continue
+
+            # 同じ時刻の中では番号の小さいものが古く、番号の無いもの(時刻で切り替えたファイル)が最も新しい
+            time_key, index = match.group(1), match.group(2)
+            order = (time_key, int(index) if index else float('inf'))
+            removable = raw_path not in self._archive_pending
+            old_files.append((order, _stat.st_size, entry.path, removable))
+
+        old_files.sort()
+        file_num = len(old_files)
+        for _, size, path, removable in old_files:
+            count_over = self.backup_count and file_num > self.backup_count
+            size_over = self.max_total_bytes and total_bytes > self.max_total_bytes
+            if not (count_over or size_over):
+                break
+            if not removable:
+                continue
+
+            os.remove(path)
+            file_num -= 1
+            total_bytes -= size
 
     def emit(self, record):
         try:
-            self._update_logfile()
+            # 切り替え時刻と比較するだけにし、ログ毎の時刻の文字列化を避ける
+            if record.created >= self._next_rollover:
+                self._update_logfile()
+
             msg = self.format(record)
             self.stream.write(msg + '\n')
-            self.stream.flush()
+
+            self._pending_records += 1
+            self._pending_bytes += len(msg) + 1
+            if (record.levelno >= ERROR
+                    or self._pending_records >= self.flush_records
+                    or (self.flush_bytes and self._pending_bytes >= self.flush_bytes)
+                    or (self.flush_interval and record.created - self._last_flush >= self.flush_interval)):
+                self._flush_stream(record.created)
+
+            # 未flushのログが残る場合、flush_interval後にflushするタイマーを動かす
+            elif self.flush_interval and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
         except Exception:
             self.handleError(record)
 
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self._flush_stream(time.time())
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        if self._archiver is not None:
+            self._archiver.shutdown(wait=True)
+        super().close()
+
+
+class BoundedQueueHandler(handlers.QueueHandler):
+    """
+    ログをキューに入れるだけのHandler。フォーマット/出力はQueueListenerのスレッドで行う。
+    キューが満杯の場合の動作はoverflowで指定する。
+      'block': 空きができるまで待つ
+      'drop-oldest': 最も古いログを捨てて入れる
+      'drop-debug': DEBUGのログは捨て、それ以外は空きができるまで待つ
+    """
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = 'block'):
+        super().__init__(log_queue)
+        self.overflow = overflow
+        self.listener = None
+        self.drop_num = 0
+
+        assert self.overflow in ('block', 'drop-oldest', 'drop-debug')
+
+    def prepare(self, record):
+        # 同一プロセス内のキューのため、メッセージの組み立てもリスナー側で行う。
+        # ログ出力後に引数のオブジェクトを変更すると、変更後の値が出力される場合がある
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow == 'drop-debug':
+            if record.levelno <= DEBUG:
+                self.drop_num += 1
+                return
+            self.queue.put(record)
+            return
+
+        # drop-oldest
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.drop_num += 1
+            except queue.Empty:
+                pass
+
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                continue
+
     def close(self):
-        if self.stream:
-            self.stream.close()
+        # 停止時にキューに残ったログを全て出力する
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
         super().close()
 
 
+class _ProcessQueueHandler(BoundedQueueHandler):
+    """
+    LogServerのキューへログを送るHandler。満杯の場合の動作はBoundedQueueHandlerと同じ。
+    別プロセスへ送るため、メッセージを組み立て、例外は文字列(exc_text)にしてから入れる。
+    メッセージと例外は別の項目のまま送り、出力の書式はLogServer側のFormatterで決める。
+    """
+
+    _exc_formatter = Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _LogQueueListener(handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # キューが満杯でも停止できるよう、空きを待って停止指示を入れる
+        self.queue.put(self._sentinel)
+
+
+# LogRecordの標準の属性。これ以外の属性はextraで渡された項目として出力する
+_RECORD_ATTRS = frozenset(LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(Formatter):
+    """
+    1レコードを1行のJSONで出力する。extraで渡した項目も出力する。
+    書式文字列の展開は行わず、エンコーダは生成時に1度だけ作る。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+
+    def format(self, record):
+        item = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'name': record.name,
+                'func': record.funcName,
+                'line': record.lineno,
+                'message': record.getMessage()}
+
+        for key, val in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                item[key] = val
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            item['exc_info'] = record.exc_text
+        if record.stack_info:
+            item['stack_info'] = self.formatStack(record.stack_info)
+
+        return self._encode(item)
+
+
 def _set_level(level: str) -> int:
     if level.lower() == 'debug':
         return DEBUG
@@ -77,7 +404,10 @@ def _set_level(level: str) -> int:
         return WARNING
 
 
-def _set_format(date_fmt=None, fmt=None) -> Formatter:
+def _set_format(date_fmt=None, fmt=None, json_format=False) -> Formatter:
+
+    if json_format:
+        return JsonFormatter()
 
     if date_fmt is None:
         date_fmt = '%m/%d,%H:%M:%S'
@@ -95,38 +425,158 @@ def setup_logger(log_dir: str = './log',
                  console_out: bool = True,
                  file_out: bool = True,
                  fmt = None,
-                 date_fmt=None):
+                 date_fmt=None,
+                 json_format: bool = False,
+                 async_mode: bool = False,
+                 queue_size: int = 10000,
+                 overflow: str = 'block',
+                 flush_records: int = 1,
+                 flush_bytes: int = 0,
+                 flush_interval: float = 0.0,
+                 max_bytes: int = 0,
+                 compress: str | None = None,
+                 backup_count: int = 0,
+                 max_total_bytes: int = 0,
+                 log_queue=None):
     # Set logger
     log_level = _set_level(level)
-    log_formatter = _set_format(fmt=fmt, date_fmt=date_fmt)
+    log_formatter = _set_format(fmt=fmt, date_fmt=date_fmt, json_format=json_format)
     log_id = file_name.split('.')[0]
 
     logger = getLogger(log_id)
     logger.setLevel(log_level)
 
     if not logger.handlers:
-        # Set File-Output
-        if file_out:
+        log_handlers = []
+
+        # Set File-Output: log_queueを指定した場合は、LogServerのプロセスへ送る
+        if file_out and log_queue is not None:
+            qh = _ProcessQueueHandler(log_queue, overflow=overflow)
+            qh.setLevel(log_level)
+            log_handlers.append(qh)
+
+        elif file_out:
             os.makedirs(log_dir, exist_ok=True)
 
             fh = CustomFileHandler(log_dir=log_dir,
                                    base_name=file_name,
-                                   rotation=log_rotate)
+                                   rotation=log_rotate,
+                                   flush_records=flush_records,
+                                   flush_bytes=flush_bytes,
+                                   flush_interval=flush_interval,
+                                   max_bytes=max_bytes,
+                                   compress=compress,
+                                   backup_count=backup_count,
+                                   max_total_bytes=max_total_bytes)
 
             fh.setLevel(log_level)
             fh.setFormatter(log_formatter)
-            logger.addHandler(fh)
+            log_handlers.append(fh)
 
         # Set Console-Output
         if console_out:
             sh = StreamHandler()
             sh.setLevel(log_level)
             sh.setFormatter(log_formatter)
-            logger.addHandler(sh)
+            log_handlers.append(sh)
+
+        # Set Async-Output: フォーマット/出力をバックグラウンドのスレッドで行う
+        if async_mode and log_handlers:
+            log_queue = queue.Queue(maxsize=queue_size)
+            listener = _LogQueueListener(log_queue, *log_handlers, respect_handler_level=True)
+            listener.start()
+
+            qh = BoundedQueueHandler(log_queue, overflow=overflow)
+            qh.listener = listener
+            qh.setLevel(log_level)
+            log_handlers = [qh]
+
+        for handler in log_handlers:
+            logger.addHandler(handler)
 
     return logger
 
 
+def _log_server_main(log_queue,
+                     log_dir: str,
+                     file_name: str,
+                     log_rotate: str,
+                     level: str,
+                     fmt,
+                     date_fmt,
+                     json_format: bool,
+                     handler_kwargs: dict):
+    # LogServerのプロセスで実行する。Noneを受け取るまでキューのログをファイルへ出力する
+    log_level = _set_level(level)
+
+    fh = CustomFileHandler(log_dir=log_dir,
+                           base_name=file_name,
+                           rotation=log_rotate,
+                           **handler_kwargs)
+    fh.setLevel(log_level)
+    fh.setFormatter(_set_format(fmt=fmt, date_fmt=date_fmt, json_format=json_format))
+
+    try:
+        while True:
+            record = log_queue.get()
+            if record is None:
+                break
+            fh.handle(record)
+    finally:
+        fh.close()
+
+
+class LogServer:
+    """
+    複数プロセスのログのファイル出力を、1つのプロセスに集約する。
+    各プロセスはsetup_logger(log_queue=server.queue)でロガーを作り、ログをキューで送る。
+    ファイルの書き込みと切り替えはLogServerのプロセスのみが行う。
+    """
+
+    def __init__(self,
+                 log_dir: str = './log',
+                 file_name: str = 'mylogger.log',
+                 log_rotate: str = 'day',
+                 level: str = 'debug',
+                 fmt=None,
+                 date_fmt=None,
+                 json_format: bool = False,
+                 queue_size: int = 10000,
+                 **handler_kwargs):
+        """
+        :param log_dir: ログホルダ
+        :param file_name: ログファイル名
+        :param log_rotate: 'day' or 'month'
+        :param level: 出力するログレベル
+        :param fmt: ログの書式
+        :param date_fmt: 日時の書式
+        :param json_format: JSON形式で出力するかどうか
+        :param queue_size: キューの最大数。満杯の場合の送信側の動作はsetup_loggerのoverflowに従う
+                           (デフォルトの'block'では空きができるまで待つ)
+        :param handler_kwargs: CustomFileHandlerへ渡すその他の引数(flush_records, max_bytesなど)
+        """
+        self.queue = multiprocessing.Queue(maxsize=queue_size)
+        self._process = multiprocessing.Process(target=_log_server_main,
+                                                args=(self.queue, log_dir, file_name, log_rotate, level,
+                                                      fmt, date_fmt, json_format, handler_kwargs),
+                                                daemon=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._process.start()
+        return self
+
+    def stop(self) -> None:
+        # キューに残ったログを全て出力してから終了する
+        self.queue.put(None)
+        self._process.join()
+
+
 def example():
     logger = setup_logger()
 
@@ -146,5 +596,29 @@ def example():
         time.sleep(30)
 
 
+_worker_logger = None
+
+
+def _example_worker_init(log_queue):
+    global _worker_logger
+    _worker_logger = setup_logger(file_name='mylogger.log', console_out=False, log_queue=log_queue)
+
+
+def _example_worker(task_no: int) -> int:
+    _worker_logger.info(f'task: {task_no}, pid: {os.getpid()}')
+    return task_no
+
+
+def example_multiprocess():
+    from concurrent.futures import ProcessPoolExecutor
+
+    with LogServer(log_dir='./log', file_name='mylogger.log') as server:
+        with ProcessPoolExecutor(max_workers=4,
+                                 initializer=_example_worker_init,
+                                 initargs=(server.queue,)) as executor:
+            for _ in executor.map(_example_worker, range(100)):
+                pass
+
+
 if __name__ == '__main__':
     example()
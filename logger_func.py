@@ -1,11 +1,49 @@
 import os
 import time
 import datetime
-from logging import (getLogger, Logger, Formatter,
+import json
+from logging import (getLogger, Logger, Formatter, LogRecord,
                      FileHandler, StreamHandler, handlers,
                      DEBUG, INFO, WARNING, ERROR, CRITICAL)
 
 
+# LogRecordの標準の属性。これ以外の属性はextraで渡された項目として出力する
+_RECORD_ATTRS = frozenset(LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(Formatter):
+    """
+    1レコードを1行のJSONで出力する。extraで渡した項目も出力する。
+    書式文字列の展開は行わず、エンコーダは生成時に1度だけ作る。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+
+    def format(self, record):
+        item = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'name': record.name,
+                'func': record.funcName,
+                'line': record.lineno,
+                'message': record.getMessage()}
+
+        for key, val in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                item[key] = val
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            item['exc_info'] = record.exc_text
+        if record.stack_info:
+            item['stack_info'] = self.formatStack(record.stack_info)
+
+        return self._encode(item)
+
+
 def _set_level(level: str)->int:
     if level.lower() == 'debug':
         return DEBUG
@@ -21,7 +59,10 @@ def _set_level(level: str)->int:
         return WARNING
 
 
-def _set_format()->Formatter:
+def _set_format(json_format: bool = False)->Formatter:
+    if json_format:
+        return JsonFormatter()
+
     _date_fmt = '%m/%d,%H:%M:%S'
     _fmt = '%(asctime)s,%(msecs)03d,[%(levelname).4s][%(funcName)s][%(lineno)d], %(message)s'
 
@@ -33,10 +74,12 @@ def make_logger(log_dir: str = './log',
                 file_name: str = 'mylogger',
                 console_out: bool = True,
                 file_out: bool = True,
-                logger_id: str = 'MyLogger') -> Logger:
+                logger_id: str = 'MyLogger',
+                backup_count: int = 0,
+                json_format: bool = False) -> Logger:
     # Set logger
     log_level = _set_level(level)
-    log_formatter = _set_format()
+    log_formatter = _set_format(json_format)
 
     logger = getLogger(logger_id)
     logger.setLevel(log_level)
@@ -47,7 +90,8 @@ def make_logger(log_dir: str = './log',
 
         fh = handlers.TimedRotatingFileHandler(
             f'{log_dir}/{file_name}.log',
-            when="MIDNIGHT"
+            when="MIDNIGHT",
+            backupCount=backup_count
         )
         fh.setLevel(log_level)
         fh.setFormatter(log_formatter)
@@ -1,23 +1,92 @@
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
+
+def _match_cells(values: np.ndarray, start_key: str) -> np.ndarray:
+    # 欠損以外のセルをまとめて文字列化・stripし、start_keyと比較する
+    notna = pd.notna(values)
+    matched = np.zeros(values.shape, dtype=bool)
+    matched[notna] = np.char.strip(values[notna].astype(str)) == start_key
+
+    return matched
+
+def _may_match_dtype(dtype, start_key: str) -> bool:
+    """
+    dtypeの列のセルを文字列化したものが、start_keyと一致し得るかどうか。
+    数値/日時の列は、start_keyが数値/日付の表記でなければ比較を省略できる。
+    """
+    if dtype == object:
+        return True
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return start_key in ('True', 'False')
+
+    if pd.api.types.is_numeric_dtype(dtype):
+        try:
+            float(start_key)
+        except ValueError:
+            return False
+        return True
+
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return start_key[:1].isdigit()
+
+    return True
+
+def _match_block(df: pd.DataFrame, start_key: str) -> np.ndarray:
+    matched = np.zeros(df.shape, dtype=bool)
+
+    for col_no, dtype in enumerate(df.dtypes):
+        if _may_match_dtype(dtype, start_key):
+            matched[:, col_no] = _match_cells(df.iloc[:, col_no].to_numpy(dtype=object), start_key)
+
+    return matched
 
 def _find_start_cell(df: pd.DataFrame,
-                     start_key: str):
+                     start_key: str,
+                     max_scan_rows: int | None = None,
+                     max_scan_cols: int | None = None,
+                     first_rows: int = 64):
+    """
+    start_keyと一致するセルのうち、最も上(同じ行では最も左)のセルの位置を返す。
+    先頭first_rows行から探索し、見つからなければ探索行数を倍にしながら下へ進め、見つかった時点で終了する。
+    :param df: シートのDataFrame
+    :param start_key: 探索するキー
+    :param max_scan_rows: 探索する最大行数。Noneの場合は全行
+    :param max_scan_cols: 探索する最大列数。Noneの場合は全列
+    :param first_rows: 最初に探索する行数
+    :return: (行番号, 列番号)。見つからない場合はNone
+    """
 
     # strip
-    df = df.map(lambda x: str(x).strip() if pd.notna(x) else x)
     start_key = start_key.strip()
 
-    # start_keyが含まれているか判別。含まれてなければNoneを返す
-    matched_cells = (df == start_key)
-    if not matched_cells.any().any():
-        return None
+    n_rows = len(df) if max_scan_rows is None else min(len(df), max_scan_rows)
+    n_cols = df.shape[1] if max_scan_cols is None else min(df.shape[1], max_scan_cols)
+
+    row0 = 0
+    chunk_rows = first_rows
+    while row0 < n_rows:
+        row1 = min(row0 + chunk_rows, n_rows)
+        matched = _match_block(df.iloc[row0:row1, :n_cols], start_key)
+
+        # nonzeroは行優先の順で返すため、先頭が左上のセル
+        rows, cols = matched.nonzero()
+        if len(rows):
+            return row0 + int(rows[0]), int(cols[0])
 
-    # 左上の行番号・列番号を返す
-    rows, cols = matched_cells.to_numpy().nonzero()
-    row_no = int(rows.min())
-    col_no = int(cols[rows == row_no].min())
+        row0 = row1
+        chunk_rows *= 2
 
-    return row_no, col_no
+    # start_keyが含まれていなければNoneを返す
+    return None
 
 def _clean_dataframe(df_org: pd.DataFrame, row0: int, col0: int) -> pd.DataFrame:
 
@@ -33,6 +102,276 @@ def _clean_dataframe(df_org: pd.DataFrame, row0: int, col0: int) -> pd.DataFrame
 
     return df
 
+def _find_start_in_row(row: tuple, start_key: str) -> int | None:
+    for col_no, val in enumerate(row):
+        if val is not None and str(val).strip() == start_key:
+            return col_no
+
+    return None
+
+def _make_chunk(rows: list, header: list[str], row_no: int) -> pd.DataFrame:
+    # 行の長さを揃え、シート先頭からの行番号をindexにする
+    n_cols = len(header)
+    rows = [row + (None,) * (n_cols - len(row)) if len(row) < n_cols else row for row in rows]
+    df = pd.DataFrame(rows, columns=header, index=range(row_no, row_no + len(rows)))
+
+    # 全NaNの行をドロップ。列は保持しておく。
+    return df.dropna(axis=0, how='all')
+
+def _iter_sheet_chunks(ws,
+                       start_key: str,
+                       max_scan_rows: int | None = None,
+                       chunk_rows: int = 10000):
+    """
+    シートを1行ずつ読み込み、start_keyを含む行をヘッダとして、以降の行をchunk_rows行毎のDataFrameで返す。
+    start_keyが見つからないシートは、ヘッダ探索の途中で読込を打ち切る。
+    """
+    start_key = start_key.strip()
+    rows = ws.iter_rows(values_only=True)
+
+    # ヘッダ行の探索
+    col0 = None
+    for row_no, row in enumerate(rows):
+        if max_scan_rows is not None and row_no >= max_scan_rows:
+            return
+
+        col0 = _find_start_in_row(row, start_key)
+        if col0 is not None:
+            break
+
+    if col0 is None:
+        return
+
+    header = ['nan' if val is None else str(val).strip() for val in row[col0:]]
+    n_cols = len(header)
+
+    buf = []
+    data_row_no = 0
+    for row in rows:
+        buf.append(row[col0:col0 + n_cols])
+        if len(buf) >= chunk_rows:
+            yield _make_chunk(buf, header, data_row_no)
+            data_row_no += len(buf)
+            buf = []
+
+    if buf:
+        yield _make_chunk(buf, header, data_row_no)
+
+def iter_xlsx_chunks(file_name: str,
+                     start_key: str = '検査日',
+                     max_scan_rows: int | None = None,
+                     chunk_rows: int = 10000):
+    """
+    ワークブックを読み取り専用モードで開き、start_keyを含むシートのデータをchunk_rows行毎に返す。
+    :param file_name: xlsxファイル名
+    :param start_key: ヘッダ行の探索キー
+    :param max_scan_rows: ヘッダ行を探索する最大行数。Noneの場合は全行
+    :param chunk_rows: 1つのDataFrameの最大行数
+    :return: (シート名, DataFrame)のイテレータ
+    """
+    wb = load_workbook(file_name, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            for df in _iter_sheet_chunks(ws, start_key, max_scan_rows, chunk_rows):
+                yield ws.title, df
+    finally:
+        wb.close()
+
+def read_xlsx_stream(file_name: str,
+                     start_key: str = '検査日',
+                     max_scan_rows: int | None = None,
+                     chunk_rows: int = 10000) -> dict[str, pd.DataFrame]:
+    """
+    iter_xlsx_chunksで読み込み、start_keyを含むシート毎にDataFrameへまとめる。
+    :param file_name: xlsxファイル名
+    :param start_key: ヘッダ行の探索キー
+    :param max_scan_rows: ヘッダ行を探索する最大行数。Noneの場合は全行
+    :param chunk_rows: 一度に変換する行数
+    :return: シート名 -> DataFrame
+    """
+    chunks = {}
+    for sheet_name, df in iter_xlsx_chunks(file_name, start_key, max_scan_rows, chunk_rows):
+        chunks.setdefault(sheet_name, []).append(df)
+
+    return {sheet_name: pd.concat(dfs) for sheet_name, dfs in chunks.items()}
+
+def _file_hash(file_name: str, chunk_size: int = 1024 * 1024) -> str:
+    _hash = hashlib.sha1()
+    with open(file_name, 'rb') as fr:
+        while chunk := fr.read(chunk_size):
+            _hash.update(chunk)
+
+    return _hash.hexdigest()
+
+def _normalize_for_arrow(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Feather/Parquetで保存できる形に整える。
+    indexを振り直し、列名を重複の無い文字列にし、型が混在する列は文字列にする(欠損は保持)。
+    """
+    df = df.reset_index(drop=True)
+
+    columns = []
+    counts = {}
+    for column in map(str, df.columns):
+        if column in counts:
+            counts[column] += 1
+            column = f'{column}.{counts[column]}'
+        else:
+            counts[column] = 0
+        columns.append(column)
+    df.columns = columns
+
+    for column in columns:
+        if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna=True).startswith('mixed'):
+            df[column] = df[column].map(lambda x: str(x) if pd.notna(x) else None)
+
+    return df
+
+def _evict_cache(cache_dir: str, max_cache_bytes: int) -> None:
+    """
+    キャッシュの合計サイズがmax_cache_bytesを超える場合、最終利用が古いものから削除する。
+    最終利用時刻はインデックスファイル(.json)の更新時刻とする。
+    """
+    entries = {}
+    for entry in os.scandir(cache_dir):
+        key = entry.name.split('_', 1)[0].split('.', 1)[0]
+        try:
+            _stat = entry.stat()
+        except FileNotFoundError:
+            continue
+
+        _item = entries.setdefault(key, {'size': 0, 'atime': 0.0, 'paths': []})
+        _item['size'] += _stat.st_size
+        _item['paths'].append(entry.path)
+        if entry.name.endswith('.json'):
+            _item['atime'] = _stat.st_mtime
+
+    total = sum(item['size'] for item in entries.values())
+    for item in sorted(entries.values(), key=lambda x: x['atime']):
+        if total <= max_cache_bytes:
+            break
+
+        # 他のプロセスが先に削除した場合は無視する
+        for path in item['paths']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= item['size']
+
+def read_xlsx_cached(file_name: str,
+                     start_key: str = '検査日',
+                     cache_dir: str = './xlsx_cache',
+                     max_cache_bytes: int = 1024 * 1024 * 1024,
+                     max_scan_rows: int | None = None,
+                     chunk_rows: int = 10000) -> dict[str, pd.DataFrame]:
+    """
+    read_xlsx_streamの結果をFeather形式でディスクにキャッシュする。
+    キャッシュはワークブックの内容のハッシュ値とstart_key, max_scan_rowsで識別し、シート毎に1ファイルとする。
+    合計サイズがmax_cache_bytesを超えた場合、最終利用が古いものから削除する。
+    :param file_name: xlsxファイル名
+    :param start_key: ヘッダ行の探索キー
+    :param cache_dir: キャッシュホルダ名
+    :param max_cache_bytes: キャッシュの最大合計サイズ[byte]
+    :param max_scan_rows: ヘッダ行を探索する最大行数。Noneの場合は全行
+    :param chunk_rows: 一度に変換する行数
+    :return: シート名 -> DataFrame(indexは0からの連番)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # 探索行数の上限で結果が変わるため、キーに含める
+    key = hashlib.sha1(f'{_file_hash(file_name)}\0{start_key}\0{max_scan_rows}'.encode('utf-8')).hexdigest()
+    index_file = os.path.join(cache_dir, f'{key}.json')
+
+    # キャッシュがあれば読み込み、最終利用時刻を更新する
+    if os.path.isfile(index_file):
+        with open(index_file, 'r', encoding='utf-8') as fr:
+            sheet_files = json.load(fr)
+
+        paths = {sheet_name: os.path.join(cache_dir, _file) for sheet_name, _file in sheet_files.items()}
+        if all(os.path.isfile(path) for path in paths.values()):
+            os.utime(index_file)
+            return {sheet_name: pd.read_feather(path) for sheet_name, path in paths.items()}
+
+    sheets = read_xlsx_stream(file_name, start_key, max_scan_rows, chunk_rows)
+
+    sheet_files = {}
+    for sheet_no, (sheet_name, df) in enumerate(sheets.items()):
+        df = _normalize_for_arrow(df)
+        sheets[sheet_name] = df
+
+        _file = f'{key}_{sheet_no}.feather'
+        df.to_feather(os.path.join(cache_dir, _file))
+        sheet_files[sheet_name] = _file
+
+    # インデックスは最後に書き込み、書きかけのキャッシュを使わないようにする
+    tmp_file = f'{index_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fw:
+        json.dump(sheet_files, fw, ensure_ascii=False)
+    os.replace(tmp_file, index_file)
+
+    _evict_cache(cache_dir, max_cache_bytes)
+
+    return sheets
+
+def _load_sheets(file_name: str,
+                 start_key: str,
+                 cache_dir: str | None,
+                 max_scan_rows: int | None) -> list[pd.DataFrame]:
+    # 並列処理のワーカーで実行する。元ファイル名/シート名を列として付加する
+    if cache_dir is None:
+        sheets = read_xlsx_stream(file_name, start_key, max_scan_rows)
+    else:
+        sheets = read_xlsx_cached(file_name, start_key, cache_dir, max_scan_rows=max_scan_rows)
+
+    dfs = []
+    for sheet_name, df in sheets.items():
+        df = _normalize_for_arrow(df)
+        df.insert(0, 'sheet_name', sheet_name)
+        df.insert(0, 'source_file', file_name)
+        dfs.append(df)
+
+    return dfs
+
+def read_xlsx_dir(data_dir: str = '.',
+                  out_file: str | None = 'combined.parquet',
+                  start_key: str = '検査日',
+                  workers: int | None = None,
+                  cache_dir: str | None = None,
+                  max_scan_rows: int | None = None) -> pd.DataFrame:
+    """
+    data_dir以下の全xlsxファイルをプロセスプールで並列に読み込み、1つのDataFrameに結合する。
+    元ファイル名/シート名はsource_file/sheet_name列とし、結合結果は型付きのParquetで出力する。
+    :param data_dir: データホルダ名
+    :param out_file: 出力ファイル名(Parquet)。Noneの場合は出力しない
+    :param start_key: ヘッダ行の探索キー
+    :param workers: プロセス数。Noneの場合はCPU数
+    :param cache_dir: キャッシュホルダ名。Noneの場合はキャッシュを使わない
+    :param max_scan_rows: ヘッダ行を探索する最大行数。Noneの場合は全行
+    :return: 結合したDataFrame
+    """
+    # Excelが作るロックファイル(~$xxx.xlsx)は除く
+    file_names = sorted(f for f in glob.glob(f'{data_dir}/**/*.xlsx', recursive=True)
+                        if not os.path.basename(f).startswith('~$'))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_load_sheets, file_names, repeat(start_key),
+                               repeat(cache_dir), repeat(max_scan_rows))
+        dfs = [df for sheet_dfs in results for df in sheet_dfs]
+
+    if not dfs:
+        return pd.DataFrame(columns=['source_file', 'sheet_name'])
+
+    # ファイル毎に型が異なる列は、結合後に改めて揃える
+    df = _normalize_for_arrow(pd.concat(dfs, ignore_index=True))
+    df['source_file'] = df['source_file'].astype('category')
+    df['sheet_name'] = df['sheet_name'].astype('category')
+
+    if out_file is not None:
+        df.to_parquet(out_file, index=False)
+
+    return df
+
 def main():
     sheets = pd.read_excel("データ.xlsx", sheet_name=None)
 
@@ -47,6 +386,13 @@ def main():
         df = _clean_dataframe(df,ret[0], ret[1])
         print(df.head(100))
 
+def main_stream():
+    sheets = read_xlsx_stream("データ.xlsx", start_key='検査日')
+
+    for sheet_name, df in sheets.items():
+        print(sheet_name)
+        print(df.head(100))
+
 
 if __name__ == '__main__':
     main()
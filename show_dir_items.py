@@ -1,5 +1,8 @@
-import glob
+import datetime
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 
 def _show_dir(target_dir: str,
@@ -9,36 +12,322 @@ def _show_dir(target_dir: str,
               depth_str: str = '---') -> None:
     if depth > depth_max: return
 
-    files_and_dirs = glob.glob(f'{target_dir}/*')
-    files_and_dirs.sort(key=lambda x: True if os.path.isfile(x) else False)
+    # DirEntryの種別情報を使い、項目毎のstatを避ける。
+    # ファイルはfile_max + 1個目を見つけた時点で以降を保持しない
+    dirs = []
+    files = []
+    file_over = False
+    try:
+        with os.scandir(target_dir) as it:
+            for entry in it:
+                # globと同じく、隠しファイル/ホルダは除く
+                if entry.name.startswith('.'):
+                    continue
 
-    file_cnt = 0
-    for item in files_and_dirs:
-        if os.path.isdir(item):
-            print(f'{depth_str * depth}{os.path.basename(item)}')
-            _show_dir(item, depth + 1, depth_max, file_max, depth_str)
-        else:
-            file_cnt += 1
-            if file_cnt < file_max + 1:
-                print(f'{depth_str * depth}{os.path.basename(item)}')
-            elif file_cnt == file_max + 1:
-                print(f'{depth_str * depth}etc...')
-            else:
-                break
+                if entry.is_dir():
+                    dirs.append(entry)
+                elif file_over:
+                    continue
+                elif len(files) < file_max:
+                    files.append(entry.name)
+                else:
+                    file_over = True
+    except OSError:
+        return
+
+    for entry in dirs:
+        print(f'{depth_str * depth}{entry.name}')
+        _show_dir(entry.path, depth + 1, depth_max, file_max, depth_str)
+
+    for name in files:
+        print(f'{depth_str * depth}{name}')
+    if file_over:
+        print(f'{depth_str * depth}etc...')
 
 
 def show_dir_items(data_dir: str = '.',
                    show_depth_num: int = 3,
-                   show_file_num: int = 3) -> None:
+                   show_file_num: int = 3,
+                   index_file: str | None = None) -> None:
     """
     ホルダ内のホルダ/ファイルを探索し、ホルダ構造を出力する
     :param data_dir: 探索する親ホルダ
     :param show_depth_num: どこまで深いホルダを探索するか
     :param show_file_num: 同一ホルダ内のファイルを何個出力するか
+    :param index_file: 指定した場合、DirIndexのファイルを更新し、その内容から出力する
     :return:
     """
+    if index_file is not None:
+        with DirIndex(index_file) as index:
+            index.refresh(data_dir)
+            index.show(data_dir, show_depth_num, show_file_num, '\t')
+        return
+
     _show_dir(data_dir, 0, show_depth_num, show_file_num, '\t')
 
 
+@dataclass
+class DirNode:
+    """
+    ホルダの集計結果。size/file_num/mtimeは配下の全ホルダを含む合計値
+    """
+    name: str
+    path: str
+    size: int = 0
+    file_num: int = 0
+    mtime: float = 0.0
+    children: list['DirNode'] = field(default_factory=list)
+
+
+def _scan_files(path: str, name: str) -> tuple[DirNode, list[os.DirEntry]]:
+    """
+    ホルダ直下のファイルを集計し、サブホルダのリストを返す。シンボリックリンクはたどらない。
+    """
+    node = DirNode(name=name, path=path)
+    sub_dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(entry)
+                        continue
+                    _stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                node.size += _stat.st_size
+                node.file_num += 1
+                node.mtime = max(node.mtime, _stat.st_mtime)
+    except OSError:
+        pass
+
+    return node, sub_dirs
+
+
+def _scan_tree(path: str, name: str) -> DirNode:
+    node, sub_dirs = _scan_files(path, name)
+    for entry in sub_dirs:
+        node.children.append(_scan_tree(entry.path, entry.name))
+
+    return node
+
+
+def _sum_tree(node: DirNode) -> None:
+    # 子ホルダの合計値を親へ足し込む
+    for child in node.children:
+        _sum_tree(child)
+        node.size += child.size
+        node.file_num += child.file_num
+        node.mtime = max(node.mtime, child.mtime)
+
+
+def _iter_nodes(node: DirNode):
+    yield node
+    for child in node.children:
+        yield from _iter_nodes(child)
+
+
+def _format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f'{size:.1f}{unit}'
+        size /= 1024
+
+
+def aggregate_dir_items(data_dir: str = '.',
+                        workers: int = 8,
+                        parallel_depth: int = 2,
+                        top_num: int = 10,
+                        verbose: bool = True) -> DirNode:
+    """
+    ホルダ内を探索し、ホルダ毎の合計サイズ/ファイル数/最新更新時刻を集計する。
+    parallel_depth階層目のホルダ以下の部分木は、スレッドプールで並列に探索する。
+    隠しファイル/ホルダも集計に含める。
+    :param data_dir: 探索する親ホルダ
+    :param workers: スレッド数
+    :param parallel_depth: 並列に探索する部分木の階層。それより浅い階層は順に探索する
+    :param top_num: サイズの大きい順に何個のホルダを出力するか
+    :param verbose: 集計結果を出力するかどうか
+    :return: data_dirの集計結果
+    """
+    root, sub_dirs = _scan_files(data_dir, os.path.basename(os.path.abspath(data_dir)))
+
+    # 浅い階層を順に探索し、並列に探索する部分木を集める
+    frontier = [(root, entry) for entry in sub_dirs]
+    for _ in range(parallel_depth - 1):
+        next_frontier = []
+        for parent, entry in frontier:
+            node, _sub_dirs = _scan_files(entry.path, entry.name)
+            parent.children.append(node)
+            next_frontier += [(node, _entry) for _entry in _sub_dirs]
+        frontier = next_frontier
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(parent, executor.submit(_scan_tree, entry.path, entry.name))
+                   for parent, entry in frontier]
+        for parent, future in futures:
+            parent.children.append(future.result())
+
+    _sum_tree(root)
+
+    if verbose:
+        print(f'{root.path}: {_format_size(root.size)}, {root.file_num} files')
+
+        nodes = sorted(_iter_nodes(root), key=lambda x: x.size, reverse=True)
+        for node in [n for n in nodes if n is not root][:top_num]:
+            _mtime = datetime.datetime.fromtimestamp(node.mtime) if node.mtime else '-'
+            print(f'{_format_size(node.size):>10}\t{node.file_num:>8}\t{_mtime}\t{node.path}')
+
+    return root
+
+
+class DirIndex:
+    """
+    ホルダ構造をSQLiteに保存する。
+    refreshでは更新時刻(mtime)が変わったホルダのみ再探索し、変わっていないホルダはstat1回で済ませる。
+    ホルダのmtimeは直下の項目の追加/削除/名前変更で変わるため、ファイルの中身の変更は検出しない。
+    ホルダへのシンボリックリンクはたどらず、ファイルとして記録する。
+    """
+
+    def __init__(self, db_file: str = 'dir_index.db'):
+        """
+        :param db_file: インデックスファイル名
+        """
+        self._conn = sqlite3.connect(db_file)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                name TEXT,
+                mtime_ns INTEGER);
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+            CREATE TABLE IF NOT EXISTS files (
+                dir_path TEXT,
+                name TEXT);
+            CREATE INDEX IF NOT EXISTS files_dir_path ON files(dir_path);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _sub_dirs(self, path: str) -> list[tuple[str, str]]:
+        return self._conn.execute('SELECT path, name FROM dirs WHERE parent = ? ORDER BY rowid',
+                                  (path,)).fetchall()
+
+    def _delete_tree(self, path: str) -> None:
+        prefix = os.path.join(path, '')
+        for table, column in (('dirs', 'path'), ('files', 'dir_path')):
+            self._conn.execute(f'DELETE FROM {table} WHERE {column} = ? OR substr({column}, 1, ?) = ?',
+                               (path, len(prefix), prefix))
+
+    def refresh(self, data_dir: str = '.') -> int:
+        """
+        インデックスを更新する。
+        :param data_dir: 探索する親ホルダ
+        :return: 再探索したホルダ数
+        """
+        scan_num = 0
+        stack = [(data_dir, None, os.path.basename(os.path.abspath(data_dir)))]
+        while stack:
+            path, parent, name = stack.pop()
+
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                self._delete_tree(path)
+                continue
+
+            # 変更の無いホルダは、記録済みのサブホルダのみたどる
+            row = self._conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                stack.extend((_path, path, _name) for _path, _name in reversed(self._sub_dirs(path)))
+                continue
+
+            # 再探索
+            scan_num += 1
+            sub_dirs = []
+            file_names = []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        # シンボリックリンクはたどらない(循環リンクで無限に潜らないようにする)
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry)
+                        else:
+                            file_names.append(entry.name)
+            except OSError:
+                pass
+
+            # 無くなったサブホルダを削除
+            new_paths = {entry.path for entry in sub_dirs}
+            for _path, _ in self._sub_dirs(path):
+                if _path not in new_paths:
+                    self._delete_tree(_path)
+
+            self._conn.execute('INSERT INTO dirs (path, parent, name, mtime_ns) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns',
+                               (path, parent, name, mtime_ns))
+            self._conn.execute('DELETE FROM files WHERE dir_path = ?', (path,))
+            self._conn.executemany('INSERT INTO files (dir_path, name) VALUES (?, ?)',
+                                   [(path, file_name) for file_name in file_names])
+
+            stack.extend((entry.path, path, entry.name) for entry in reversed(sub_dirs))
+
+        self._conn.commit()
+
+        return scan_num
+
+    def show(self,
+             data_dir: str = '.',
+             show_depth_num: int = 3,
+             show_file_num: int = 3,
+             depth_str: str = '\t') -> None:
+        """
+        インデックスからホルダ構造を出力する。出力形式はshow_dir_itemsと同じ
+        :param data_dir: refreshで指定した親ホルダ
+        :param show_depth_num: どこまで深いホルダを出力するか
+        :param show_file_num: 同一ホルダ内のファイルを何個出力するか
+        :param depth_str: 階層のインデント文字列
+        :return:
+        """
+        self._show(data_dir, 0, show_depth_num, show_file_num, depth_str)
+
+    def _show(self, path: str, depth: int, depth_max: int, file_max: int, depth_str: str) -> None:
+        if depth > depth_max: return
+
+        for _path, name in self._sub_dirs(path):
+            if name.startswith('.'):
+                continue
+            print(f'{depth_str * depth}{name}')
+            self._show(_path, depth + 1, depth_max, file_max, depth_str)
+
+        file_names = self._conn.execute("SELECT name FROM files WHERE dir_path = ? AND name NOT GLOB '.*' "
+                                        "ORDER BY rowid LIMIT ?", (path, file_max + 1)).fetchall()
+        for name, in file_names[:file_max]:
+            print(f'{depth_str * depth}{name}')
+        if len(file_names) > file_max:
+            print(f'{depth_str * depth}etc...')
+
+    def query(self, pattern: str) -> list[str]:
+        """
+        名前がpatternに一致するホルダ/ファイルのパスを返す。
+        :param pattern: globパターン(例: '*.csv')。大文字/小文字を区別する
+        :return: パスのリスト
+        """
+        rows = self._conn.execute('SELECT path FROM dirs WHERE name GLOB ? ORDER BY rowid',
+                                  (pattern,)).fetchall()
+        rows += self._conn.execute('SELECT dir_path, name FROM files WHERE name GLOB ? ORDER BY rowid',
+                                   (pattern,)).fetchall()
+
+        return [os.path.join(*row) for row in rows]
+
+
 if __name__ == '__main__':
     show_dir_items()
@@ -1,6 +1,12 @@
 import glob
 import csv
+import json
+import os
+import re
 import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 
 def save_csv_list(output_list: list, csv_file: str):
@@ -72,5 +78,410 @@ def xml2csv(data_dir: str = '.', res_file: str = 'results.csv', debug: bool = Fa
         save_csv_list(out_list, res_file)
 
 
+_LEVEL_NAMES = {1: '1st', 2: '2nd', 3: '3rd'}
+
+
+def _iter_xml_rows(file_name: str):
+    """
+    xmlファイルを逐次パースし、要素が閉じた時点で出力行を返す。
+    出力済みの要素は親要素から切り離し、メモリ使用量をファイルサイズによらず一定に保つ。
+    xml2csvと同じく3階層目までを出力するが、出力順は子要素が先になる。
+    :param file_name: xmlファイル名
+    :return: [file_name, 階層, tag, attrib, text]のイテレータ
+    """
+    # 開いている要素のスタック。要素が閉じたら親要素から削除する
+    stack = []
+    for event, elem in ET.iterparse(file_name, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+
+        depth = len(stack) - 1
+        if depth in _LEVEL_NAMES:
+            yield [file_name, _LEVEL_NAMES[depth], elem.tag, elem.attrib, elem.text]
+
+        # 出力済みの要素を破棄
+        stack.pop()
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+
+def xml2csv_stream(data_dir: str = '.', res_file: str = 'results.csv', debug: bool = False):
+    """
+    xml2csvのストリーミング版。
+    xmlファイルを逐次パースし、要素が閉じる毎にCSVへ出力する。出力ファイルは一度だけ開く。
+    :param data_dir: データホルダ名
+    :param res_file: 出力ファイル名
+    :param debug: デバッグ出力するかどうか
+    :return:
+    """
+
+    file_names = glob.glob(f"{data_dir}/*.xml")
+    with open(res_file, 'a') as f:
+        csvWriter = csv.writer(f, lineterminator='\n')
+
+        for file_name in file_names:
+            print(file_name)
+
+            for row in _iter_xml_rows(file_name):
+                if debug:
+                    print(f'\t {row[1]} tag:{row[2]} attrib:{row[3]} text:{row[4]}')
+
+                csvWriter.writerow(row)
+
+
+def _local_name(tag: str) -> str:
+    # '{namespace}tag' -> 'tag'
+    return tag.rsplit('}', 1)[-1]
+
+
+class _PathFilter:
+    """
+    要素のパス('/root/item/name')に対するXPath風のinclude/excludeフィルタ。
+    パターンは'/'区切りで、'*'は任意の1階層、'//'は任意の深さの階層にマッチする。
+    '/'で始まらないパターンは任意の位置にマッチする('//'を先頭に付けたものと同じ)。
+    """
+
+    def __init__(self,
+                 include: list[str] | None = None,
+                 exclude: list[str] | None = None):
+        include = [self._normalize(p) for p in include or []]
+        exclude = [self._normalize(p) for p in exclude or []]
+
+        self._include = [self._compile(p) for p in include]
+        self._exclude = [self._compile(p) for p in exclude]
+
+        # '//'を含まないincludeパターンは、階層毎の比較で枝刈りに使う
+        self._include_steps = []
+        self._include_any = False
+        for p in include:
+            if '//' in p:
+                self._include_any = True
+            else:
+                self._include_steps.append([self._compile_step(s) for s in p[1:].split('/')])
+
+    @staticmethod
+    def _normalize(pattern: str) -> str:
+        pattern = pattern.rstrip('/')
+        return pattern if pattern.startswith('/') else f'//{pattern}'
+
+    @staticmethod
+    def _compile_step(step: str) -> re.Pattern:
+        return re.compile('[^/]+' if step == '*' else re.escape(step))
+
+    @staticmethod
+    def _compile(pattern: str) -> re.Pattern:
+        _regex = ''
+        for token in re.split(r'(//|/)', pattern):
+            if token == '//':
+                _regex += '(?:/[^/]+)*/'
+            elif token == '/':
+                _regex += '/'
+            elif token == '*':
+                _regex += '[^/]+'
+            elif token:
+                _regex += re.escape(token)
+
+        return re.compile(_regex)
+
+    def excluded(self, path: str) -> bool:
+        return any(p.fullmatch(path) for p in self._exclude)
+
+    def included(self, path: str) -> bool:
+        if not self._include:
+            return True
+        return any(p.fullmatch(path) for p in self._include)
+
+    def may_contain(self, path: str) -> bool:
+        """
+        pathの子孫がincludeパターンにマッチする可能性があるかどうか。
+        Falseの場合、その部分木は探索しなくてよい。
+        """
+        if self._include_any:
+            return True
+
+        names = path[1:].split('/')
+        for steps in self._include_steps:
+            if len(names) < len(steps) and all(s.fullmatch(n) for s, n in zip(steps, names)):
+                return True
+
+        return False
+
+
+def _iter_flat_elements(root: ET.Element, path_filter: _PathFilter):
+    """
+    要素木を再帰を使わずに深さ優先(文書順)で走査する。
+    excludeにマッチした要素と、includeにマッチし得ない部分木は探索しない。
+    includeにマッチした要素は、その子孫も全て出力対象とする。
+    :param root: ルート要素
+    :param path_filter: パスのフィルタ
+    :return: (階層, パス, 要素)のイテレータ。ルートの階層は0
+    """
+    stack = [(root, f'/{_local_name(root.tag)}', 0, False)]
+    while stack:
+        elem, path, depth, included = stack.pop()
+
+        if path_filter.excluded(path):
+            continue
+
+        included = included or path_filter.included(path)
+        if included:
+            yield depth, path, elem
+        elif not path_filter.may_contain(path):
+            continue
+
+        # 文書順に取り出すため、逆順に積む
+        for child in reversed(elem):
+            stack.append((child, f'{path}/{_local_name(child.tag)}', depth + 1, included))
+
+
+def _collect_attr_keys(file_name: str,
+                       include: list[str] | None = None,
+                       exclude: list[str] | None = None) -> list[str]:
+    """
+    出力対象の要素の属性名を出現順に集める。
+    """
+    path_filter = _PathFilter(include, exclude)
+    root = ET.parse(file_name).getroot()
+
+    attr_keys = {}
+    for _, _, elem in _iter_flat_elements(root, path_filter):
+        for key in elem.attrib:
+            attr_keys.setdefault(key, None)
+
+    return list(attr_keys)
+
+
+def _flatten_xml(file_name: str,
+                 attr_keys: list[str],
+                 include: list[str] | None = None,
+                 exclude: list[str] | None = None) -> list[list]:
+    """
+    xmlファイルの全階層の要素を出力行に変換する。
+    :param file_name: xmlファイル名
+    :param attr_keys: 列として出力する属性名のリスト
+    :param include: 出力する部分木のパスパターン。Noneの場合は全て
+    :param exclude: 出力しない部分木のパスパターン
+    :return: [file_name, 階層, パス, tag, text, 属性...]のリスト
+    """
+    path_filter = _PathFilter(include, exclude)
+    root = ET.parse(file_name).getroot()
+
+    out_list = []
+    for depth, path, elem in _iter_flat_elements(root, path_filter):
+        text = elem.text.strip() if elem.text else ''
+        attrib = elem.attrib
+        out_list.append([file_name, depth, path, elem.tag, text] +
+                        [attrib.get(key, '') for key in attr_keys])
+
+    return out_list
+
+
+def _union_keys(key_lists) -> list[str]:
+    attr_keys = {}
+    for keys in key_lists:
+        for key in keys:
+            attr_keys.setdefault(key, None)
+
+    return list(attr_keys)
+
+
+def _flat_header(attr_keys: list[str]) -> list[str]:
+    return ['file_name', 'depth', 'path', 'tag', 'text'] + [f'@{key}' for key in attr_keys]
+
+
+def xml2csv_flat(data_dir: str = '.',
+                 res_file: str = 'results.csv',
+                 include: list[str] | None = None,
+                 exclude: list[str] | None = None,
+                 attr_keys: list[str] | None = None,
+                 debug: bool = False):
+    """
+    dataホルダ中のxmlファイルの全階層の要素をCSVに出力する。
+    各行には要素のパス/階層を出力し、属性は'@属性名'の列に展開する。
+    :param data_dir: データホルダ名
+    :param res_file: 出力ファイル名
+    :param include: 出力する部分木のパスパターンのリスト(例: ['/root/items', '//item'])。Noneの場合は全て
+    :param exclude: 出力しない部分木のパスパターンのリスト
+    :param attr_keys: 列として出力する属性名のリスト。Noneの場合、全ファイルを事前に走査して集める
+    :param debug: デバッグ出力するかどうか
+    :return:
+    """
+
+    file_names = glob.glob(f"{data_dir}/*.xml")
+
+    if attr_keys is None:
+        attr_keys = _union_keys(_collect_attr_keys(file_name, include, exclude)
+                                for file_name in file_names)
+
+    with open(res_file, 'w') as f:
+        csvWriter = csv.writer(f, lineterminator='\n')
+        csvWriter.writerow(_flat_header(attr_keys))
+
+        for file_name in file_names:
+            print(file_name)
+
+            out_list = _flatten_xml(file_name, attr_keys, include, exclude)
+            if debug:
+                for row in out_list:
+                    print('\t' * row[1] + f'{row[2]} text:{row[4]}')
+
+            csvWriter.writerows(out_list)
+
+
+def _iter_ordered(executor, func, file_names: list[str], max_pending: int, *args):
+    """
+    file_namesの各ファイルをexecutorで処理し、ファイル順に結果を返す。
+    未取得の結果はmax_pending個までとし、呼び出し元の処理が遅い場合は投入を待たせる。
+    """
+    pending = deque()
+    for file_name in file_names:
+        pending.append(executor.submit(func, file_name, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _load_checkpoint(ckpt_file: str) -> tuple[list[str] | None, set[str], int | None]:
+    """
+    チェックポイントファイルを読み込む。
+    1行目は属性名のリストとヘッダ出力後のサイズ、2行目以降は出力済みのファイル名と出力後のサイズ。
+    書き込み途中で中断した最終行は切り捨てる。
+    :param ckpt_file: チェックポイントファイル名
+    :return: 属性名のリスト, 出力済みファイル名, 出力ファイルの有効なサイズ[byte]
+    """
+    attr_keys = None
+    done_files = set()
+    offset = None
+    valid_size = 0
+
+    with open(ckpt_file, 'rb') as fr:
+        for line in fr:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+            if 'attr_keys' in item:
+                attr_keys = item['attr_keys']
+            else:
+                done_files.add(item['file'])
+            offset = item['offset']
+            valid_size += len(line)
+
+    os.truncate(ckpt_file, valid_size)
+
+    return attr_keys, done_files, offset
+
+
+def _write_checkpoint(fc, item: dict) -> None:
+    fc.write(json.dumps(item, ensure_ascii=False) + '\n')
+    fc.flush()
+    os.fsync(fc.fileno())
+
+
+def _sync_size(f) -> int:
+    # ディスクへ書き出し、確定したファイルサイズを返す
+    f.flush()
+    os.fsync(f.fileno())
+    return os.fstat(f.fileno()).st_size
+
+
+def xml2csv_batch(data_dir: str = '.',
+                  res_file: str = 'results.csv',
+                  workers: int | None = None,
+                  include: list[str] | None = None,
+                  exclude: list[str] | None = None,
+                  attr_keys: list[str] | None = None,
+                  checkpoint: bool = False,
+                  resume: bool = True):
+    """
+    xml2csv_flatの並列版。
+    xmlファイルのパースをプロセスプールで行い、出力は1つの開いたままのCSVへまとめて書き込む。
+    出力はファイル名順で、同じファイルの行は連続して出力する。
+    checkpoint=Trueの場合、ファイル毎に出力をディスクへ書き出してres_file + '.ckpt'に記録し、
+    中断後の再実行では出力途中の行を切り捨てて、未完了のファイルから再開する。
+    チェックポイントは全ファイルの出力が完了した時点と、チェックポイント無しで実行を始めた時点で削除する。
+    :param data_dir: データホルダ名
+    :param res_file: 出力ファイル名
+    :param workers: プロセス数。Noneの場合はCPU数
+    :param include: 出力する部分木のパスパターンのリスト。Noneの場合は全て
+    :param exclude: 出力しない部分木のパスパターンのリスト
+    :param attr_keys: 列として出力する属性名のリスト。Noneの場合、全ファイルを事前に走査して集める。
+                      再開時はチェックポイントに記録した属性名を使う
+    :param checkpoint: ファイル毎にチェックポイントを記録するかどうか
+    :param resume: チェックポイントがあれば再開するかどうか。Falseの場合は最初から実行する
+    :return:
+    """
+
+    file_names = sorted(glob.glob(f"{data_dir}/*.xml"))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    max_pending = workers * 2
+
+    ckpt_file = f'{res_file}.ckpt'
+    done_files = set()
+    offset = None
+    if checkpoint and resume and os.path.isfile(ckpt_file) and os.path.isfile(res_file):
+        _attr_keys, done_files, offset = _load_checkpoint(ckpt_file)
+
+        # 出力ファイルが記録より小さい場合は、別の実行で書き換えられているため最初から実行する
+        if offset is not None and offset > os.path.getsize(res_file):
+            print(f'checkpoint does not match {res_file}: restart')
+            offset = None
+
+        if offset is None:
+            done_files = set()
+        else:
+            attr_keys = _attr_keys
+    elif os.path.isfile(ckpt_file):
+        # 古いチェックポイントで、この実行の出力を切り詰めないよう削除する
+        os.remove(ckpt_file)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if offset is None:
+            # 新規に実行。ヘッダを出力する
+            if attr_keys is None:
+                attr_keys = _union_keys(_iter_ordered(executor, _collect_attr_keys, file_names,
+                                                      max_pending, include, exclude))
+
+            with open(res_file, 'w') as f:
+                csvWriter = csv.writer(f, lineterminator='\n')
+                csvWriter.writerow(_flat_header(attr_keys))
+                offset = _sync_size(f)
+
+            if checkpoint:
+                with open(ckpt_file, 'w', encoding='utf-8') as fc:
+                    _write_checkpoint(fc, {'attr_keys': attr_keys, 'offset': offset})
+        else:
+            # 再開。最後に完了したファイル以降の書きかけの行を切り捨てる
+            os.truncate(res_file, offset)
+            print(f'resume: {len(done_files)} files done')
+
+        todo_files = [file_name for file_name in file_names if file_name not in done_files]
+
+        with open(res_file, 'a') as f, \
+                open(ckpt_file, 'a', encoding='utf-8') if checkpoint else nullcontext() as fc:
+            csvWriter = csv.writer(f, lineterminator='\n')
+
+            for file_name, out_list in zip(todo_files,
+                                           _iter_ordered(executor, _flatten_xml, todo_files,
+                                                         max_pending, attr_keys, include, exclude)):
+                print(file_name)
+                csvWriter.writerows(out_list)
+
+                if checkpoint:
+                    _write_checkpoint(fc, {'file': file_name, 'offset': _sync_size(f)})
+
+        # 全ファイルの出力が完了したため、次回の実行では再開しない
+        if checkpoint:
+            os.remove(ckpt_file)
+
+
 if __name__ == '__main__':
     xml2csv(debug=True)